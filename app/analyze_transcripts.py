@@ -0,0 +1,162 @@
+"""
+Analyzes transcripts from the command line, without the web app and the queue. Writes one CSV report per transcript
+into the output folder as soon as it is analyzed, and prints the throughput at the end.
+
+Usage:
+
+  python3 analyze_transcripts.py ../example/interview_transcripts -o reports --workers 4
+  python3 analyze_transcripts.py 'archive/**/*.docx' input.json -o reports --corenlp-url http://localhost
+
+Inputs are folders, files or glob patterns of .docx transcripts or .json lists of question-answer pairs.
+"""
+import argparse
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import time
+import traceback
+
+import global_config
+from global_config import logger
+
+
+TRANSCRIPT_EXTENSIONS = ('.docx', '.json')
+
+
+def find_transcripts(inputs):
+    paths = []
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            matches = [os.path.join(pattern, name) for name in sorted(os.listdir(pattern))]
+        else:
+            matches = sorted(glob.glob(pattern, recursive=True))
+        paths += [path for path in matches if os.path.isfile(path) and path.lower().endswith(TRANSCRIPT_EXTENSIONS)]
+    # Drop duplicates, keeping the order
+    return list(dict.fromkeys(paths))
+
+
+def output_paths(paths, output_dir):
+    """
+    Returns the path of the report of each transcript, named after the transcript.
+    """
+    outputs = []
+    taken = set()
+    for path in paths:
+        stem = os.path.splitext(os.path.basename(path))[0]
+        name = stem
+        i = 1
+        while name in taken:
+            i += 1
+            name = '{}-{}'.format(stem, i)
+        taken.add(name)
+        outputs.append(os.path.join(output_dir, name + '.csv'))
+    return outputs
+
+
+def analyze(paths):
+    """
+    Analyzes the transcript at paths[0] into the report at paths[1]. Returns a dict with the number of 'pairs' and
+    'sentences' analyzed, the 'seconds' taken, and the 'error' if any.
+    """
+    from tension_analysis.preprocessing import Preprocessor
+    from tension_analysis_worker.process import tension_analysis
+    from tension_analysis_worker.progress import ProgressRecorder
+
+    path, output_path = paths
+    started_at = time.time()
+    progress = ProgressRecorder()
+    try:
+        if path.lower().endswith('.json'):
+            with open(path) as f:
+                questions_answers = json.load(f)
+        else:
+            with open(path, 'rb') as f:
+                questions_answers = list(Preprocessor(f).iter_ques_ans())
+
+        tmp_path = output_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            tension_analysis(questions_answers, f, progress)
+        os.replace(tmp_path, output_path)
+    except Exception as e:
+        logger.error(traceback.format_exc())
+        error = '{}: {}'.format(type(e).__name__, e)
+    else:
+        error = None
+    return {
+        'path': path,
+        'output_path': output_path,
+        'pairs': progress.state.get('pairs_done', 0),
+        'sentences': progress.state.get('sentences_done', 0),
+        'seconds': time.time() - started_at,
+        'error': error,
+    }
+
+
+def _init_worker():
+    from tension_analysis_worker import preload
+    preload.load_emotion_model()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('inputs', nargs='+', help='folders, files or glob patterns of transcripts')
+    parser.add_argument('-o', '--output-dir', required=True, help='folder of the CSV reports')
+    parser.add_argument(
+        '--workers', type=int, default=global_config.WORKER_CONCURRENCY,
+        help='number of forked processes analyzing transcripts, 0 for one per CPU (default: WORKER_CONCURRENCY)')
+    parser.add_argument('--corenlp-url', default=global_config.CORENLP_URL)
+    parser.add_argument('--corenlp-port', type=int, default=global_config.CORENLP_PORT)
+    args = parser.parse_args()
+
+    paths = find_transcripts(args.inputs)
+    if not paths:
+        parser.error('no .docx or .json transcript found')
+    os.makedirs(args.output_dir, exist_ok=True)
+    jobs = list(zip(paths, output_paths(paths, args.output_dir)))
+
+    # Loading the lexicons before forking lets the workers share them copy-on-write. Each worker loads its own copy of
+    # the model after forking: TensorFlow sessions do not survive fork().
+    global_config.CORENLP_URL = args.corenlp_url
+    global_config.CORENLP_PORT = args.corenlp_port
+    from tension_analysis_worker import preload
+
+    started_at = time.time()
+    workers = min(args.workers or os.cpu_count(), len(jobs))
+    if workers == 1:
+        preload.load_emotion_model()
+        results = map(analyze, jobs)
+        pool = None
+    else:
+        pool = multiprocessing.get_context('fork').Pool(workers, initializer=_init_worker)
+        results = pool.imap_unordered(analyze, jobs)
+
+    totals = {'transcripts': 0, 'failed': 0, 'pairs': 0, 'sentences': 0}
+    try:
+        for result in results:
+            totals['transcripts'] += 1
+            totals['pairs'] += result['pairs']
+            totals['sentences'] += result['sentences']
+            if result['error']:
+                totals['failed'] += 1
+                print('[{}/{}] FAILED {}: {}'.format(totals['transcripts'], len(jobs), result['path'], result['error']))
+            else:
+                print('[{}/{}] {} -> {} ({} pairs, {} sentences, {:.1f}s)'.format(
+                    totals['transcripts'], len(jobs), result['path'], result['output_path'],
+                    result['pairs'], result['sentences'], result['seconds']))
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    elapsed = time.time() - started_at
+    print('Analyzed {} transcripts ({} failed), {} pairs, {} sentences in {:.1f}s with {} workers: '
+          '{:.2f} transcripts/s, {:.1f} sentences/s'.format(
+              totals['transcripts'], totals['failed'], totals['pairs'], totals['sentences'], elapsed, workers,
+              totals['transcripts'] / elapsed, totals['sentences'] / elapsed))
+    return 1 if totals['failed'] else 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    raise SystemExit(main())
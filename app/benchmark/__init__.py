@@ -0,0 +1,4 @@
+"""
+Stand-ins for the external services of the worker, so that run_benchmark.py measures the pipeline offline and
+reproducibly.
+"""
@@ -0,0 +1,191 @@
+"""
+Deterministic stand-in for the CoreNLP server. Answers the 'depparse,pos' requests of the worker with rule-based
+tokens, tags and dependencies in the JSON format of CoreNLP, and counts the requests it serves.
+
+Usage:
+
+  server = FakeCoreNLPServer(latency=0.005)
+  server.start()
+  global_config.CORENLP_URL, global_config.CORENLP_PORT = server.url, server.port
+  ...
+  server.stats()  # {'requests': ..., 'sentences': ...}
+  server.stop()
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import re
+import threading
+import time
+
+
+TOKEN_REGEX = re.compile(r"\w+(?:'\w+)?|[^\w\s]")
+SENTENCE_ENDS = {'.', '?', '!'}
+TAGS = {
+    'i': 'PRP', 'you': 'PRP', 'he': 'PRP', 'she': 'PRP', 'we': 'PRP', 'they': 'PRP', 'it': 'PRP',
+    'to': 'TO', 'that': 'IN', 'of': 'IN', 'in': 'IN', 'on': 'IN', 'at': 'IN', 'about': 'IN', 'with': 'IN',
+    'for': 'IN', 'from': 'IN', 'by': 'IN', 'like': 'IN', 'so': 'IN',
+    'the': 'DT', 'a': 'DT', 'an': 'DT', 'this': 'DT', 'these': 'DT',
+    'should': 'MD', 'would': 'MD', 'could': 'MD', 'can': 'MD', 'will': 'MD', 'may': 'MD', 'might': 'MD',
+    'must': 'MD',
+    'is': 'VBZ', 'are': 'VBP', 'was': 'VBD', 'were': 'VBD', 'be': 'VB', 'have': 'VBP', 'has': 'VBZ', 'had': 'VBD',
+    'do': 'VBP', 'did': 'VBD', 'think': 'VBP', 'feel': 'VBP', 'believe': 'VBP', 'suppose': 'VBP', 'assume': 'VBP',
+    'appear': 'VBP', 'tend': 'VBP', 'suggest': 'VBP', 'consider': 'VBP', 'doubt': 'VBP', 'guess': 'VBP',
+    'presume': 'VBP', 'hope': 'VBP', 'know': 'VBP', 'go': 'VB', 'went': 'VBD', 'said': 'VBD', 'see': 'VB',
+    'likely': 'JJ', 'not': 'RB', 'very': 'RB', 'rather': 'RB', 'well': 'RB', ',': ',',
+}
+
+
+def tag(word):
+    lower = word.lower()
+    if lower in TAGS:
+        return TAGS[lower]
+    if not word[0].isalnum():
+        return '.'
+    if word[0].isdigit():
+        return 'CD'
+    if lower.endswith('ly'):
+        return 'RB'
+    if lower.endswith('ing'):
+        return 'VBG'
+    if lower.endswith('ed'):
+        return 'VBD'
+    if lower.endswith('s') and len(lower) > 3:
+        return 'NNS'
+    return 'NN'
+
+
+def dependencies(words, tags):
+    """
+    Attaches every word to the first verb of the sentence, with the relations read by the hedge rules: 'nsubj' for the
+    nearest noun or pronoun before it, 'aux' for modals, 'ccomp' and 'xcomp' for later verbs, and 'mark' for the 'to'
+    before an 'xcomp'. Token indexes start at 1.
+    """
+    verbs = [i for i, t in enumerate(tags) if t.startswith('VB')]
+    root = verbs[0] if verbs else 0
+    deps = [('ROOT', -1, root)]
+    subject = next((i for i in range(root - 1, -1, -1) if tags[i] in ('PRP', 'NN', 'NNS')), None)
+    for i in range(len(words)):
+        if i == root:
+            continue
+        if i == subject:
+            deps.append(('nsubj', root, i))
+        elif tags[i] == 'MD':
+            deps.append(('aux', next((j for j in verbs if j > i), root), i))
+        elif tags[i].startswith('VB'):
+            if i > 0 and tags[i - 1] == 'TO':
+                deps.append(('xcomp', root, i))
+                deps.append(('mark', i, i - 1))
+            else:
+                deps.append(('ccomp', root, i))
+        elif not (i > 0 and tags[i] == 'TO' and i + 1 < len(tags) and tags[i + 1].startswith('VB')):
+            deps.append(('dep', root, i))
+    return [
+        {
+            'dep': dep,
+            'governor': governor + 1,
+            'governorGloss': 'ROOT' if governor < 0 else words[governor],
+            'dependent': dependent + 1,
+            'dependentGloss': words[dependent],
+        }
+        for dep, governor, dependent in deps
+    ]
+
+
+def annotate(text):
+    """
+    Returns the CoreNLP JSON of `text`. Sentences end at '.', '?' and '!' and at blank lines; character offsets count
+    UTF-16 code units like CoreNLP.
+    """
+    utf16_offsets = [0]
+    for ch in text:
+        utf16_offsets.append(utf16_offsets[-1] + (2 if ord(ch) > 0xFFFF else 1))
+
+    sentences = []
+    current = []
+    for paragraph in re.finditer(r'(?:(?!\n\s*\n).)+', text, re.S):
+        for match in TOKEN_REGEX.finditer(paragraph.group()):
+            current.append((match.group(), paragraph.start() + match.start(), paragraph.start() + match.end()))
+            if match.group() in SENTENCE_ENDS:
+                sentences.append(current)
+                current = []
+        if current:
+            sentences.append(current)
+            current = []
+
+    result = []
+    for index, sentence in enumerate(sentences):
+        words = [word for word, _, _ in sentence]
+        tags = [tag(word) for word in words]
+        result.append({
+            'index': index,
+            'basicDependencies': dependencies(words, tags),
+            'tokens': [
+                {
+                    'index': i + 1,
+                    'word': word,
+                    'originalText': word,
+                    'pos': tags[i],
+                    'characterOffsetBegin': utf16_offsets[begin],
+                    'characterOffsetEnd': utf16_offsets[end],
+                }
+                for i, (word, begin, end) in enumerate(sentence)
+            ],
+        })
+    return {'sentences': result}
+
+
+class FakeCoreNLPServer(object):
+    """
+    Serves annotate() on 127.0.0.1 from a background thread. Each request sleeps `latency` seconds plus
+    `latency_per_sentence` seconds per sentence, to model the cost of the real server.
+    """
+    def __init__(self, port=0, latency=0.0, latency_per_sentence=0.0):
+        self.latency = latency
+        self.latency_per_sentence = latency_per_sentence
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.sentences = 0
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), self._handler_class())
+        self.httpd.daemon_threads = True
+        self.url = 'http://127.0.0.1'
+        self.port = self.httpd.server_address[1]
+        self.thread = None
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                text = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+                body = annotate(text)
+                n = len(body['sentences'])
+                time.sleep(server.latency + server.latency_per_sentence * n)
+                with server.lock:
+                    server.requests += 1
+                    server.sentences += n
+
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def stats(self):
+        with self.lock:
+            return {'requests': self.requests, 'sentences': self.sentences}
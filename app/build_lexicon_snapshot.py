@@ -0,0 +1,13 @@
+"""
+Compiles the lexicons under DATA_ROOT into the binary snapshot loaded by the worker at startup.
+The worker also refreshes a missing or stale snapshot itself, if it can write to DATA_ROOT.
+"""
+import logging
+
+import global_config
+from tension_analysis_worker.lexicons import SNAPSHOT_PATH, build_snapshot
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    build_snapshot('{}/{}'.format(global_config.DATA_ROOT, SNAPSHOT_PATH), global_config.DATA_ROOT)
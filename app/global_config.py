@@ -1,11 +1,71 @@
+import os
+
 DEBUG = False
 
+# Internal nginx location of STORAGE_PATH. nginx sends result downloads (with Range and conditional requests) when set,
+# Python does when None. Only set it behind the bundled nginx: docker-compose.yml sets
+# TENSION_ANALYSIS_ACCEL_REDIRECT_PREFIX=/protected_results/.
+ACCEL_REDIRECT_PREFIX = os.environ.get('TENSION_ANALYSIS_ACCEL_REDIRECT_PREFIX') or None
+# Maximum number of transcripts in one batch upload
+BATCH_MAX_TRANSCRIPTS = 500
 CSV_DELIMITER = ','
 CSV_QUOTECHAR = '"'
+# Maximum number of texts and characters sent to CoreNLP in one annotation request
+CORENLP_BATCH_MAX_CHARS = 20000
+CORENLP_BATCH_MAX_TEXTS = 100
+# Number of distinct sentences whose CoreNLP annotation is kept in memory
+CORENLP_CACHE_SIZE = 4096
+# Number of concurrent requests to the CoreNLP server while annotating ahead of the hedge rules
+CORENLP_CONCURRENCY = 8
+# Port of the CoreNLP server at CORENLP_URL
+CORENLP_PORT = 9999
+# Number of Q/A pairs whose sentences are annotated ahead at a time
+CORENLP_PREFETCH_WINDOW = 100
+# Seconds to wait for a CoreNLP response
+CORENLP_TIMEOUT = 60
+# CoreNLP server annotating the sentences for the hedge rules
+CORENLP_URL = 'http://stanford_corenlp'
 DATA_ROOT = '/srv/data'
+# Number of sentences fed to the emotion model per predict step
+EMOTION_BATCH_SIZE = 256
+# Number of predicted emotions kept in memory, keyed by cleaned sentence
+EMOTION_CACHE_SIZE = 50000
+# SQLite file shared by the workers of a host as a second cache tier, or None. Keep it on a local disk.
+EMOTION_DISK_CACHE_PATH = None
+EMOTION_DISK_CACHE_SIZE = 1000000
 HEDGE_DETECTION_THRESHOLD = 0.8
+# Store uploads as is and extract the question-answer pairs in the worker, instead of during the upload request
+PARSE_IN_WORKER = True
+# Seconds between two stack samples of a profiled job
+PROFILE_INTERVAL = 0.01
+# Fraction of jobs profiled at random, saving profile.folded next to their results. TENSION_ANALYSIS_PROFILE_SAMPLE_RATE
+# overrides it.
+PROFILE_SAMPLE_RATE = 0.0
+# Profile every job and keep the profiles of the ones taking at least this many seconds, or None.
+# TENSION_ANALYSIS_PROFILE_SLOW_JOB_SECONDS overrides it.
+PROFILE_SLOW_JOB_SECONDS = None
+# The job progress is rewritten at most every PROGRESS_MIN_INTERVAL seconds unless it moved by PROGRESS_MIN_STEP percent
+PROGRESS_MIN_INTERVAL = 2
+PROGRESS_MIN_STEP = 5
+# 'file' keeps one file per job and also works on network filesystems. 'sqlite' claims jobs from an SQLite table,
+# which needs STORAGE_PATH on a local filesystem shared by the web app and the workers of the same host.
+QUEUE_BACKEND = 'file'
+# Seconds between two renewals of the claim of a running job. Keep it well below QUEUE_VISIBILITY_TIMEOUT.
+QUEUE_HEARTBEAT_INTERVAL = 60
+# Maximum seconds an idle worker waits before looking at the queue again
+QUEUE_POLL_INTERVAL = 2
+# Seconds after which a job whose worker stopped renewing its claim (see QUEUE_HEARTBEAT_INTERVAL) is handed out again
+QUEUE_VISIBILITY_TIMEOUT = 3600
+# Number of Q/A pairs written to the partial result per durable chunk
+RESULT_CHUNK_SIZE = 10
+# Also write a gzip-compressed copy of finished results, for nginx to serve to clients accepting gzip
+RESULT_GZIP = True
 STORAGE_PATH = '/mnt/tension_analysis_results'
 USER_IDENTIFICATION_COOKIE_NAME = 'uid'
+# Number of distinct words whose VADER scores are kept in memory
+VADER_CACHE_SIZE = 100000
+# Number of forked worker processes run by run_worker.py. 1 runs in-process; 0 means one per CPU.
+WORKER_CONCURRENCY = 1
 
 
 import logging  # noqa
@@ -0,0 +1,133 @@
+"""
+Timers and counters of the worker stages. The code being measured reports to the Metrics of the running job:
+
+  with metrics.timer('emotion_predict'):
+      model.predict(...)
+  metrics.count('corenlp_texts', len(batch))
+
+The worker collects every job in a fresh Metrics (see job()), saves them next to the results of the job and adds
+them to the totals of the process, which the web app renders for Prometheus (see render_prometheus()).
+"""
+import contextlib
+import functools
+import threading
+import time
+
+
+class Metrics(object):
+    """
+    Call counts and seconds per timer, and values per counter. Safe to update from several threads.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.timers = {}  # name -> [calls, seconds]
+        self.counters = {}
+
+    def add_time(self, name, seconds, calls=1):
+        with self._lock:
+            timer = self.timers.setdefault(name, [0, 0.0])
+            timer[0] += calls
+            timer[1] += seconds
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def merge(self, other):
+        """
+        Adds the timers and counters of `other`, a Metrics or its to_dict().
+        """
+        if isinstance(other, Metrics):
+            other = other.to_dict()
+        for name, timer in other.get('timers', {}).items():
+            self.add_time(name, timer['seconds'], timer['calls'])
+        for name, value in other.get('counters', {}).items():
+            self.count(name, value)
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'timers': {
+                    name: {'calls': calls, 'seconds': seconds} for name, (calls, seconds) in self.timers.items()
+                },
+                'counters': dict(self.counters),
+            }
+
+
+# The metrics of the running job
+current = Metrics()
+
+
+@contextlib.contextmanager
+def timer(name):
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        current.add_time(name, time.perf_counter() - started_at)
+
+
+def timed(name):
+    """
+    Decorator timing every call of the function.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, value=1):
+    current.count(name, value)
+
+
+def hit_rates(counters):
+    """
+    Returns the hit rate of every cache with <cache>_hits and <cache>_misses counters, None for unused caches.
+    """
+    rates = {}
+    for name, hits in counters.items():
+        if name.endswith('_hits'):
+            cache = name[:-len('_hits')]
+            lookups = hits + counters.get(cache + '_misses', 0)
+            rates[cache] = hits / lookups if lookups else None
+    return rates
+
+
+@contextlib.contextmanager
+def job():
+    """
+    Collects the metrics reported inside the block into a fresh Metrics, which it yields.
+    """
+    global current
+    previous = current
+    current = Metrics()
+    try:
+        yield current
+    finally:
+        current = previous
+
+
+def render_prometheus(metrics, prefix='tension_analysis_worker'):
+    """
+    Returns the metrics as Prometheus text exposition: the timers as <prefix>_stage_calls_total and
+    <prefix>_stage_seconds_total labelled by stage, and every counter as <prefix>_<counter>_total.
+    """
+    if isinstance(metrics, Metrics):
+        metrics = metrics.to_dict()
+    lines = []
+    timers = sorted(metrics.get('timers', {}).items())
+    for field, help_text in [('calls', 'Number of times the stage ran'), ('seconds', 'Seconds spent in the stage')]:
+        name = '{}_stage_{}_total'.format(prefix, field)
+        lines.append('# HELP {} {}.'.format(name, help_text))
+        lines.append('# TYPE {} counter'.format(name))
+        for stage, timer in timers:
+            lines.append('{}{{stage="{}"}} {}'.format(name, stage, timer[field]))
+    for counter, value in sorted(metrics.get('counters', {}).items()):
+        name = '{}_{}_total'.format(prefix, counter)
+        lines.append('# TYPE {} counter'.format(name))
+        lines.append('{} {}'.format(name, value))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,221 @@
+"""
+Measures the worker pipeline offline: the preprocessing of the example transcripts, get_emotion, is_hedged_sentence
+and tension_analysis on the examples and on synthetic transcripts scaled up from them. CoreNLP is replaced by the
+deterministic server of benchmark.fake_corenlp and, unless --model real, the emotion model by benchmark.stub_model.
+Caches are emptied before each stage.
+
+Reports latency percentiles per stage, sentences/s, peak RSS and CoreNLP requests, and saves them as JSON:
+
+  python3 run_benchmark.py -o before.json
+  python3 run_benchmark.py -o after.json --compare before.json
+"""
+import argparse
+import glob
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import subprocess
+import time
+
+import numpy as np
+
+import global_config
+from benchmark import stub_model
+from benchmark.fake_corenlp import FakeCoreNLPServer
+
+
+EXAMPLES_GLOB = str(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../example/interview_transcripts/*.docx'))
+
+
+def clear_caches():
+    from tension_analysis_worker import process
+    from tension_analysis_worker.utils import emotion_helpers, hedge_detection
+
+    hedge_detection.annotation_cache.clear()
+    process.emotion_cache.memory.clear()
+    emotion_helpers.vader_word_scores.cache_clear()
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def summarize(latencies):
+    latencies = np.array(latencies, dtype=np.float64)
+    if not len(latencies):
+        return {'count': 0}
+    return {
+        'count': len(latencies),
+        'total': float(latencies.sum()),
+        'mean': float(latencies.mean()),
+        'p50': float(np.percentile(latencies, 50)),
+        'p90': float(np.percentile(latencies, 90)),
+        'p99': float(np.percentile(latencies, 99)),
+        'max': float(latencies.max()),
+    }
+
+
+def synthetic_transcript(pairs, n_pairs, seed):
+    """
+    Returns `n_pairs` pairs drawn from `pairs`. Answers drawn again are marked with the number of the draw, so that
+    they miss the caches like new answers would.
+    """
+    rng = random.Random(seed)
+    transcript = []
+    drawn = {}
+    for _ in range(n_pairs):
+        i = rng.randrange(len(pairs))
+        question, answer = pairs[i]
+        drawn[i] = drawn.get(i, 0) + 1
+        if drawn[i] > 1:
+            answer = '{} That was the take number {}.'.format(answer, drawn[i])
+        transcript.append((question, answer))
+    return transcript
+
+
+def run_stage(name, items, fn, server, results):
+    """
+    Calls fn(item) for each item with empty caches, timing each call. fn may return a dict of counts to sum up.
+    """
+    clear_caches()
+    before = server.stats()
+    latencies = []
+    counts = {}
+    started_at = time.time()
+    for item in items:
+        t = time.perf_counter()
+        count = fn(item)
+        latencies.append(time.perf_counter() - t)
+        for key, value in (count or {}).items():
+            counts[key] = counts.get(key, 0) + value
+    elapsed = time.time() - started_at
+    after = server.stats()
+
+    stage = summarize(latencies)
+    stage.update(counts)
+    stage['corenlp_requests'] = after['requests'] - before['requests']
+    stage['corenlp_sentences'] = after['sentences'] - before['sentences']
+    if 'sentences' in counts:
+        stage['sentences_per_second'] = counts['sentences'] / elapsed if elapsed else None
+    stage['peak_rss_mb'] = peak_rss_mb()
+    results[name] = stage
+
+    print('{:<28} n={:<5} p50={:8.4f}s p90={:8.4f}s p99={:8.4f}s max={:8.4f}s corenlp={:<6}{}'.format(
+        name, stage['count'], stage.get('p50', 0), stage.get('p90', 0), stage.get('p99', 0), stage.get('max', 0),
+        stage['corenlp_requests'],
+        ' {:.1f} sentences/s'.format(stage['sentences_per_second']) if stage.get('sentences_per_second') else ''))
+
+
+def compare(results, baseline):
+    print('\nCompared with the baseline (new / old):')
+    for name, stage in results['stages'].items():
+        old = baseline.get('stages', {}).get(name)
+        if not old or not old.get('p50') or 'p50' not in stage:
+            continue
+        line = '{:<28} p50 {:6.2f}x'.format(name, stage['p50'] / old['p50'])
+        if stage.get('sentences_per_second') and old.get('sentences_per_second'):
+            line += '  sentences/s {:6.2f}x'.format(stage['sentences_per_second'] / old['sentences_per_second'])
+        if old.get('corenlp_requests'):
+            line += '  corenlp requests {:6.2f}x'.format(stage['corenlp_requests'] / old['corenlp_requests'])
+        print(line)
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-o', '--output', default='benchmark.json', help='JSON file of the results')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare with')
+    parser.add_argument('--examples', default=EXAMPLES_GLOB, help='glob pattern of the example transcripts')
+    parser.add_argument(
+        '--synthetic-pairs', type=int, nargs='*', default=[500, 2000],
+        help='sizes of the synthetic transcripts, in question-answer pairs')
+    parser.add_argument('--sentences', type=int, default=500, help='sentences timed one by one per sentence stage')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--model', choices=['stub', 'real'], default='stub')
+    parser.add_argument('--model-latency', type=float, default=0.0, help='seconds per sentence of the stub model')
+    parser.add_argument('--corenlp-latency', type=float, default=0.002, help='seconds per fake CoreNLP request')
+    parser.add_argument(
+        '--corenlp-latency-per-sentence', type=float, default=0.001, help='seconds per sentence in a request')
+    args = parser.parse_args()
+
+    server = FakeCoreNLPServer(latency=args.corenlp_latency, latency_per_sentence=args.corenlp_latency_per_sentence)
+    server.start()
+    global_config.CORENLP_URL = server.url
+    global_config.CORENLP_PORT = server.port
+    global_config.EMOTION_DISK_CACHE_PATH = None
+    if args.model == 'stub':
+        stub_model.install(args.model_latency)
+
+    started_at = time.time()
+    from nltk import sent_tokenize
+    from tension_analysis.preprocessing import Preprocessor
+    from tension_analysis_worker.process import get_emotion, tension_analysis
+    from tension_analysis_worker.progress import ProgressRecorder
+    from tension_analysis_worker.preload import load_emotion_model
+    from tension_analysis_worker.utils.hedge_detection import is_hedged_sentence
+    load_emotion_model()
+    results = {
+        'config': vars(args),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'revision': _git_revision(),
+        'startup_seconds': time.time() - started_at,
+        'stages': {},
+    }
+    stages = results['stages']
+
+    paths = sorted(glob.glob(args.examples))
+    if not paths:
+        parser.error('no example transcript matches {}'.format(args.examples))
+    transcripts = []
+
+    def preprocess(path):
+        with open(path, 'rb') as f:
+            transcripts.append(list(Preprocessor(f).iter_ques_ans()))
+        return {'pairs': len(transcripts[-1])}
+    run_stage('preprocess', paths, preprocess, server, stages)
+
+    pairs = [pair for transcript in transcripts for pair in transcript]
+    sentences = [s for pair in pairs for s in sent_tokenize(pair[1].lower())[:5]]
+    sentences = random.Random(args.seed).sample(sentences, min(args.sentences, len(sentences)))
+    run_stage('get_emotion', sentences, lambda s: {'sentences': 1} if get_emotion(s) else None, server, stages)
+    run_stage('is_hedged_sentence', sentences, lambda s: {'sentences': 1, 'hedged': int(is_hedged_sentence(s))},
+              server, stages)
+
+    def analyze(transcript):
+        progress = ProgressRecorder()
+        with open(os.devnull, 'w') as f:
+            tension_analysis(transcript, f, progress)
+        return {'pairs': progress.state.get('pairs_done', 0), 'sentences': progress.state.get('sentences_done', 0)}
+    run_stage('tension_analysis/examples', transcripts, analyze, server, stages)
+    for n_pairs in args.synthetic_pairs:
+        run_stage('tension_analysis/synthetic-{}'.format(n_pairs),
+                  [synthetic_transcript(pairs, n_pairs, args.seed)], analyze, server, stages)
+
+    results['peak_rss_mb'] = peak_rss_mb()
+    server.stop()
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Peak RSS {:.0f} MB. Results saved to {}'.format(results['peak_rss_mb'], args.output))
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    main()
@@ -1,20 +1,88 @@
+import os
+import signal
 import time
 import traceback
 
+import global_config
 from global_config import logger
-from storage import take_from_queue, NothingTaken
-from tension_analysis_worker import task_tension_analysis
+from storage import set_worker_slot, take_from_queue, wait_for_queue, NothingTaken
+# Importing the task loads the lexicons, which forked workers share copy-on-write. Each worker loads its own copy of
+# the model after forking: TensorFlow sessions do not survive fork().
+from tension_analysis_worker import preload, task_tension_analysis
 
 
-if __name__ == '__main__':
-    logger.info('Worker ready.')
+def work():
     while True:
         try:
             with take_from_queue() as user_id:
-                logger.info('Worker is taking {}'.format(user_id))
+                logger.info('Worker {} is taking {}'.format(os.getpid(), user_id))
                 task_tension_analysis(user_id)
         except NothingTaken:
-            time.sleep(2)
+            wait_for_queue(global_config.QUEUE_POLL_INTERVAL)
         except Exception as e:
             logger.error('Unexpected exception. Worker quitting:')
             logger.error(traceback.format_exc())
+
+
+def spawn(slot):
+    pid = os.fork()
+    if pid:
+        return pid
+
+    # Child
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    try:
+        set_worker_slot(slot)
+        preload.load_emotion_model()
+        work()
+    except Exception:
+        logger.error(traceback.format_exc())
+    finally:
+        os._exit(1)
+
+
+def supervise(concurrency):
+    """
+    Keeps `concurrency` forked workers alive until SIGTERM or SIGINT, restarting the ones which die in their slot.
+    """
+    children = {}  # pid -> (slot, start time)
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while True:
+        while not stopping and len(children) < concurrency:
+            slot = min(set(range(concurrency)) - {used for used, _ in children.values()})
+            pid = spawn(slot)
+            children[pid] = (slot, time.time())
+            logger.info('Worker {} started in slot {}.'.format(pid, slot))
+
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        _, started_at = children.pop(pid, (None, None))
+        if stopping:
+            continue
+
+        logger.warning('Worker {} exited with status {}. Restarting.'.format(pid, status))
+        if started_at is not None and time.time() - started_at < 1:
+            time.sleep(1)  # Don't spin if workers die on startup
+
+
+if __name__ == '__main__':
+    concurrency = global_config.WORKER_CONCURRENCY or os.cpu_count()
+    if concurrency == 1:
+        preload.load_emotion_model()
+        logger.info('Worker ready.')
+        work()
+    else:
+        logger.info('Worker pool of {} ready.'.format(concurrency))
+        supervise(concurrency)
@@ -1,22 +1,58 @@
+import json
 import logging
+import os
 from pathlib import Path
 import re
+import select
 import shutil
+import socket
+import sqlite3
+import struct
+import threading
+import time
 import uuid
 
 import global_config
+import metrics
 
 logger = logging.getLogger(__name__)
 
 
-__all__ = ['CannotOpen', 'CannotSave', 'open_user_file', 'add_to_queue', 'take_from_queue', 'NothingTaken']
+__all__ = ['CannotOpen', 'CannotSave', 'open_user_file', 'user_file_path', 'remove_user_file', 'rename_user_file',
+           'create_user_file', 'read_progress', 'write_progress', 'read_batch', 'RESULT_INDEX_RECORD', 'ResultIndex',
+           'add_to_queue', 'take_from_queue', 'NothingTaken', 'wait_for_queue', 'set_worker_slot',
+           'write_worker_metrics', 'read_worker_totals', 'read_worker_metrics']
 
 FILE_CODES = {
     'input': 'input.json',
+    # The uploaded transcript, stored as is when the worker extracts the question-answer pairs
+    'upload': 'input.docx',
+    # The upload being parsed by the worker, moved aside so that a newer upload is not removed with it
+    'parsing_upload': 'input.docx.parsing',
     'percentage': 'percentage',
     'result': 'result.csv',
+    # The result being written by the worker. Only complete chunks of rows are flushed to it.
+    'partial_result': 'result.csv.tmp',
+    # Compressed copy of the result, served by nginx to clients accepting gzip
+    'result_gzip': 'result.csv.gz',
+    # Row index of the result, see ResultIndex
+    'result_index': 'result.csv.idx',
+    'partial_result_index': 'result.csv.idx.tmp',
+    # A batch of transcripts: the manifest in the folder of the user; the pointer to the user in the folder of each
+    # transcript job, and the lock electing the job which combines their results in the folder of the first job
+    'batch': 'batch.json',
+    'batch_lock': 'batch.lock',
+    'parent': 'parent.json',
+    # Timers and counters of the job, see metrics.Metrics
+    'metrics': 'metrics.json',
+    # Collapsed stacks sampled from a profiled job, for flamegraph.pl or speedscope
+    'profile': 'profile.folded',
 }
 
+# One record per row of the result, the header included: the byte offset where the row ends and the number of rows
+# labelled 'Tension' up to and including it.
+RESULT_INDEX_RECORD = struct.Struct('<QQ')
+
 
 class CannotOpen(Exception):
     pass
@@ -51,6 +87,113 @@ def open_user_file(user_id, file_code, mode='r'):
         return _open_user_file_r(user_id, FILE_CODES[file_code], mode)
 
 
+def user_file_path(user_id, file_code):
+    """
+    Returns the path of the file relative to STORAGE_PATH, e.g. for the web server to send it.
+    """
+    assert file_code in FILE_CODES
+    assert user_id, 'user_id cannot be empty'
+    return '{}/{}'.format(user_id, FILE_CODES[file_code])
+
+
+def remove_user_file(user_id, file_code):
+    """
+    Removes the file if it exists.
+    """
+    assert file_code in FILE_CODES
+    assert user_id, 'user_id cannot be empty'
+    try:
+        (Path(global_config.STORAGE_PATH) / str(user_id) / FILE_CODES[file_code]).unlink()
+    except FileNotFoundError:
+        pass
+
+
+def rename_user_file(user_id, file_code, new_file_code):
+    """
+    Renames the file atomically, replacing any file of the new code. Raises CannotOpen if it does not exist.
+    """
+    assert file_code in FILE_CODES and new_file_code in FILE_CODES
+    assert user_id, 'user_id cannot be empty'
+    folder_path = Path(global_config.STORAGE_PATH) / str(user_id)
+    try:
+        os.replace(str(folder_path / FILE_CODES[file_code]), str(folder_path / FILE_CODES[new_file_code]))
+    except OSError as e:
+        raise CannotOpen from e
+
+
+def create_user_file(user_id, file_code):
+    """
+    Creates the empty file unless it exists, atomically. Returns whether this call created it, e.g. to elect one of
+    several workers.
+    """
+    assert file_code in FILE_CODES
+    assert user_id, 'user_id cannot be empty'
+    path = Path(global_config.STORAGE_PATH) / str(user_id) / FILE_CODES[file_code]
+    try:
+        os.close(os.open(str(path), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        return False
+    except OSError as e:
+        raise CannotSave from e
+    return True
+
+
+@metrics.timed('storage_write_progress')
+def write_progress(user_id, progress):
+    with open_user_file(user_id, 'percentage', mode='w') as f:
+        json.dump(progress, f)
+
+
+def read_progress(user_id):
+    """
+    Returns the dict saved by write_progress. It has a 'percentage' from 0 to 100 and, from the worker, 'stage',
+    'pairs_done', 'pairs_total', 'sentences_done' and 'eta' (seconds or None). A failed job only has an 'error'. The
+    stage of a batch is 'batch' until the results of its transcripts are combined.
+    Raises CannotOpen if there is no report.
+    """
+    with open_user_file(user_id, 'percentage', mode='r') as f:
+        content = f.read()
+    try:
+        progress = json.loads(content)
+    except ValueError:
+        progress = content
+    # Older versions wrote a bare percentage or error message
+    if isinstance(progress, dict):
+        return progress
+    elif isinstance(progress, int):
+        return {'percentage': progress}
+    else:
+        return {'error': content}
+
+
+def read_batch(user_id):
+    """
+    Returns the transcripts of the batch of the user, a list of {'name': file name, 'job_id': user_id of its job}.
+    Raises CannotOpen if the user has no batch.
+    """
+    with open_user_file(user_id, 'batch', mode='r') as f:
+        return json.load(f)
+
+
+class ResultIndex(object):
+    """
+    Reads the records of a row index from a binary file object, seeking to each requested record. The record being
+    appended right now is left out. Usage:
+
+      index = ResultIndex(f)
+      offset, tension_rows = index[index.rows]  # totals of the result
+    """
+    def __init__(self, f):
+        self.f = f
+        # Number of rows after the header
+        self.rows = os.fstat(f.fileno()).st_size // RESULT_INDEX_RECORD.size - 1
+
+    def __getitem__(self, i):
+        assert 0 <= i <= self.rows
+        self.f.seek(i * RESULT_INDEX_RECORD.size)
+        return RESULT_INDEX_RECORD.unpack(self.f.read(RESULT_INDEX_RECORD.size))
+
+
 def _remove_if_not_regular_file(path):
     if path.is_dir() and not path.is_symlink():
         shutil.rmtree(path)
@@ -117,26 +260,246 @@ class _open_user_file_w(_open_user_file_r):
 
 # The process identifier is bound to be unique between workers.
 _UUID_REGEX = re.compile('^[0-9a-f]{32}$')
+_LOCK_REGEX = re.compile('^([0-9a-f]{32})\\.([0-9a-f]{32})$')
 _PROCESS_IDENTIFIER = uuid.uuid4().hex
 _QUEUE_FOLDER_PATH = Path(global_config.STORAGE_PATH) / 'queue'
+_DOORBELL_PATH = _QUEUE_FOLDER_PATH / 'doorbell'
+_METRICS_FOLDER_PATH = Path(global_config.STORAGE_PATH) / 'metrics'
 
 
-def add_to_queue(user_id):
+def _reset_process_identifier():
+    global _PROCESS_IDENTIFIER, _doorbell_fd
+    _PROCESS_IDENTIFIER = uuid.uuid4().hex
+    _doorbell_fd = None
+
+
+# Forked workers must not share the identifier of their parent, or they would all see each other's locks as theirs.
+os.register_at_fork(after_in_child=_reset_process_identifier)
+
+
+class _FileQueue(object):
+    """
+    One empty file per job in the queue folder, ordered by mtime. A job is claimed by renaming its file to
+    <user_id>.<process identifier>.
+    """
+    def add(self, user_id):
+        if not _QUEUE_FOLDER_PATH.is_dir():
+            _QUEUE_FOLDER_PATH.mkdir(parents=True)
+        item_path = _QUEUE_FOLDER_PATH / str(user_id)
+        _remove_if_not_regular_file(item_path)
+        try:
+            item_path.unlink()
+        except Exception:
+            pass
+        item_path.touch()
+
+    def claim(self):
+        if not _QUEUE_FOLDER_PATH.is_dir():
+            _QUEUE_FOLDER_PATH.mkdir(parents=True)
+        self._requeue_expired()
+        children = [c for c in _QUEUE_FOLDER_PATH.iterdir() if _UUID_REGEX.match(c.name)]
+        children.sort(key=lambda c: c.stat().st_mtime)  # old to new
+        for c in children:
+            if c.is_file():
+                lock_path = c.with_suffix('.' + _PROCESS_IDENTIFIER)
+                try:
+                    # Try to lock the file
+                    c.rename(lock_path)
+                    # The lock's mtime is when the job became invisible to others
+                    os.utime(str(lock_path))
+                except Exception as e:
+                    logger.warning(str(e))
+                else:
+                    return c.name, lock_path
+        return None, None
+
+    def renew(self, user_id, lock_path):
+        # The lock's mtime is when the job became invisible to others
+        try:
+            os.utime(str(lock_path))
+        except FileNotFoundError:
+            pass  # Released meanwhile
+
+    def release(self, user_id, lock_path):
+        # Remove the lock
+        if lock_path.is_file():
+            lock_path.unlink()
+
+    def _requeue_expired(self):
+        deadline = time.time() - global_config.QUEUE_VISIBILITY_TIMEOUT
+        for c in _QUEUE_FOLDER_PATH.iterdir():
+            match = _LOCK_REGEX.match(c.name)
+            try:
+                if match and c.stat().st_mtime < deadline:
+                    logger.warning('Requeueing {} abandoned by {}'.format(*match.groups()))
+                    c.rename(_QUEUE_FOLDER_PATH / match.group(1))
+            except Exception as e:
+                logger.warning(str(e))
+
+
+class _SQLiteQueue(object):
+    """
+    Jobs are rows ordered by the time they become visible. A claim hides the job for QUEUE_VISIBILITY_TIMEOUT seconds,
+    after which it is handed out again unless the claiming worker released or renewed it.
+    """
+    path = Path(global_config.STORAGE_PATH) / 'queue.sqlite3'
+
+    def _connect(self):
+        if not self.path.parent.is_dir():
+            self.path.parent.mkdir(parents=True)
+        # Connections are not shared across forked workers; open one per operation.
+        conn = sqlite3.connect(str(self.path), timeout=30, isolation_level=None)
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS jobs '
+            '(user_id TEXT PRIMARY KEY, visible_at REAL NOT NULL, owner TEXT)')
+        conn.execute('CREATE INDEX IF NOT EXISTS jobs_visible_at ON jobs (visible_at)')
+        return conn
+
+    def add(self, user_id):
+        conn = self._connect()
+        try:
+            conn.execute('INSERT OR REPLACE INTO jobs VALUES (?, ?, NULL)', (str(user_id), time.time()))
+        finally:
+            conn.close()
+
+    def claim(self):
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute(
+                'SELECT user_id, owner FROM jobs WHERE visible_at <= ? ORDER BY visible_at LIMIT 1', (now,)).fetchone()
+            if row is None:
+                conn.execute('ROLLBACK')
+                return None, None
+            user_id, previous_owner = row
+            if previous_owner:
+                logger.warning('Requeueing {} abandoned by {}'.format(user_id, previous_owner))
+            conn.execute(
+                'UPDATE jobs SET visible_at = ?, owner = ? WHERE user_id = ?',
+                (now + global_config.QUEUE_VISIBILITY_TIMEOUT, _PROCESS_IDENTIFIER, user_id))
+            conn.execute('COMMIT')
+            return user_id, _PROCESS_IDENTIFIER
+        finally:
+            conn.close()
+
+    def renew(self, user_id, owner):
+        conn = self._connect()
+        try:
+            conn.execute(
+                'UPDATE jobs SET visible_at = ? WHERE user_id = ? AND owner = ?',
+                (time.time() + global_config.QUEUE_VISIBILITY_TIMEOUT, user_id, owner))
+        finally:
+            conn.close()
+
+    def release(self, user_id, owner):
+        conn = self._connect()
+        try:
+            # The job may have been re-added since it was claimed. Leave it queued in that case.
+            conn.execute('DELETE FROM jobs WHERE user_id = ? AND owner = ?', (user_id, owner))
+        finally:
+            conn.close()
+
+
+_QUEUE_BACKENDS = {
+    'file': _FileQueue,
+    'sqlite': _SQLiteQueue,
+}
+_queue = _QUEUE_BACKENDS[global_config.QUEUE_BACKEND]()
+
+# Workers block on a named pipe in the queue folder and add_to_queue writes a byte to it, so a new job is picked up
+# immediately instead of on the next poll. Pipes only work between processes on the same host; others still poll.
+_doorbell_fd = None
+
+
+def _open_doorbell():
+    """
+    Returns the descriptor of the doorbell, reopened if the pipe was removed or replaced since it was opened, e.g. by
+    the cleanup of stale files.
+    """
+    global _doorbell_fd
+    if _doorbell_fd is not None:
+        try:
+            if os.path.samestat(os.fstat(_doorbell_fd), os.stat(str(_DOORBELL_PATH))):
+                return _doorbell_fd
+        except FileNotFoundError:
+            pass
+        os.close(_doorbell_fd)
+        _doorbell_fd = None
     if not _QUEUE_FOLDER_PATH.is_dir():
         _QUEUE_FOLDER_PATH.mkdir(parents=True)
-    item_path = _QUEUE_FOLDER_PATH / str(user_id)
-    _remove_if_not_regular_file(item_path)
     try:
-        item_path.unlink()
-    except Exception:
+        os.mkfifo(str(_DOORBELL_PATH))
+    except FileExistsError:
         pass
-    item_path.touch()
+    # Opened read-write so that the pipe always has a writer and select() does not spin on EOF.
+    _doorbell_fd = os.open(str(_DOORBELL_PATH), os.O_RDWR | os.O_NONBLOCK)
+    return _doorbell_fd
+
+
+def _ring_doorbell():
+    try:
+        fd = os.open(str(_DOORBELL_PATH), os.O_WRONLY | os.O_NONBLOCK)
+    except OSError:
+        return  # No worker is waiting on this host
+    try:
+        os.write(fd, b'\0')
+    except OSError:
+        pass  # The pipe is full; workers are awake anyway
+    finally:
+        os.close(fd)
+
+
+def wait_for_queue(timeout):
+    """
+    Blocks until add_to_queue is called on this host or `timeout` seconds have passed.
+    """
+    try:
+        fd = _open_doorbell()
+    except OSError as e:
+        logger.warning(str(e))
+        time.sleep(timeout)
+        return
+    if select.select([fd], [], [], timeout)[0]:
+        try:
+            while os.read(fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+
+def add_to_queue(user_id):
+    _queue.add(user_id)
+    _ring_doorbell()
 
 
 class NothingTaken(Exception):
     pass
 
 
+class _ClaimHeartbeat(threading.Thread):
+    """
+    Renews the claim of a running job every QUEUE_HEARTBEAT_INTERVAL seconds, so that a job is only handed out again
+    QUEUE_VISIBILITY_TIMEOUT seconds after its worker died, however long it runs.
+    """
+    def __init__(self, user_id, claim):
+        super().__init__(name='queue-heartbeat', daemon=True)
+        self.user_id = user_id
+        self.claim = claim
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(global_config.QUEUE_HEARTBEAT_INTERVAL):
+            try:
+                _queue.renew(self.user_id, self.claim)
+            except Exception as e:
+                logger.warning('Cannot renew the claim of {}: {}'.format(self.user_id, e))
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
 class take_from_queue(object):
     """
     Usage:
@@ -144,34 +507,83 @@ class take_from_queue(object):
             with take_from_queue() as user_id:
                 do_things(user_id)
         except NothingTaken:
-            pass
+            wait_for_queue(timeout)
     """
     def __init__(self):
         self.user_id = None
+        self.claim = None
+        self.heartbeat = None
 
     def __enter__(self):
-        if not _QUEUE_FOLDER_PATH.is_dir():
-            _QUEUE_FOLDER_PATH.mkdir(parents=True)
-        children = [c for c in _QUEUE_FOLDER_PATH.iterdir() if _UUID_REGEX.match(c.name)]
-        children.sort(key=lambda c: c.stat().st_mtime)  # old to new
-        for c in children:
-            if c.is_file():
-                try:
-                    self.user_id = c.name
-                    # Try to lock the file
-                    c.rename(c.with_suffix('.' + _PROCESS_IDENTIFIER))
-                    break
-                except Exception as e:
-                    logger.warning(str(e))
-
+        self.user_id, self.claim = _queue.claim()
         if self.user_id:
-            # Verify the lock again
-            if (_QUEUE_FOLDER_PATH / (self.user_id + '.' + _PROCESS_IDENTIFIER)).is_file():
-                return self.user_id
+            self.heartbeat = _ClaimHeartbeat(self.user_id, self.claim)
+            self.heartbeat.start()
+            return self.user_id
         raise NothingTaken()
 
     def __exit__(self, type, value, traceback):
-        # Remove the lock
-        p = _QUEUE_FOLDER_PATH / (self.user_id + '.' + _PROCESS_IDENTIFIER)
-        if p.is_file():
-            p.unlink()
+        self.heartbeat.stop()
+        _queue.release(self.user_id, self.claim)
+
+
+# Index of this process in its pool of workers, see set_worker_slot()
+_worker_slot = 0
+
+
+def set_worker_slot(slot):
+    """
+    Sets the index of this process in its pool of workers. The file of metrics of a worker is named after its host and
+    slot, so that a worker restarted in the same slot carries on with the totals of the one it replaces.
+    """
+    global _worker_slot
+    _worker_slot = slot
+
+
+def _worker_metrics_path():
+    return _METRICS_FOLDER_PATH / '{}-{}.json'.format(socket.gethostname(), _worker_slot)
+
+
+def write_worker_metrics(totals):
+    """
+    Saves `totals`, the metrics.Metrics.to_dict() of all jobs of this worker slot so far. The file stays after the
+    worker exits so that the sums read by read_worker_metrics() never decrease.
+    """
+    if not _METRICS_FOLDER_PATH.is_dir():
+        _METRICS_FOLDER_PATH.mkdir(parents=True, exist_ok=True)
+    path = _worker_metrics_path()
+    tmp_path = path.with_suffix('.tmp')
+    with tmp_path.open('w') as f:
+        json.dump(totals, f)
+    os.replace(str(tmp_path), str(path))
+
+
+def read_worker_totals():
+    """
+    Returns the totals last saved by write_worker_metrics() in the slot of this process, as a metrics.Metrics.
+    """
+    totals = metrics.Metrics()
+    try:
+        with _worker_metrics_path().open() as f:
+            totals.merge(json.load(f))
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        logger.warning('Cannot read worker metrics {}: {}'.format(_worker_metrics_path(), e))
+    return totals
+
+
+def read_worker_metrics():
+    """
+    Returns the totals saved by write_worker_metrics() of every worker process, added up into a metrics.Metrics.
+    """
+    totals = metrics.Metrics()
+    if not _METRICS_FOLDER_PATH.is_dir():
+        return totals
+    for path in _METRICS_FOLDER_PATH.glob('*.json'):
+        try:
+            with path.open() as f:
+                totals.merge(json.load(f))
+        except (OSError, ValueError) as e:
+            logger.warning('Cannot read worker metrics {}: {}'.format(path, e))
+    return totals
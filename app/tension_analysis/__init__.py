@@ -1,13 +1,15 @@
 """
 The entrypoint of tension analysis app.
 """
-from flask import Flask
 
 
 def create_app():
     """
     The entrypoint: factory the Flask app to share with multiple instances.
     """
+    # Import inline so that the worker can import the preprocessing without Flask
+    from flask import Flask
+
     app = Flask(__name__)
     app.config.from_object('global_config')
 
@@ -5,67 +5,117 @@ the timestamps, some don't. In case, a transcript doesn't have the timestamp, it
 manually there in order to use the following procedure
 '''
 
-from bs4 import BeautifulSoup
+from collections import deque
+from html.parser import HTMLParser
+import itertools
+
 import mammoth
 
 
 class Preprocessor(object):
+    # Characters of HTML handed to the parser at once
+    FEED_SIZE = 64 * 1024
+
     def __init__(self, file_obj):
         self.html = mammoth.convert_to_html(file_obj).value
-        self.processed_html = ""
         self.ques_ans = []
 
-    def process_html(self):
-        soup = BeautifulSoup(self.html, 'html.parser')
-        paragraphs = soup.find_all('p')
-        initial_time_index = -1
+    def iter_paragraphs(self):
+        """
+        Yields (text, is_bold) for every paragraph of the document, parsing the HTML incrementally.
+        """
+        parser = _ParagraphParser()
+        for i in range(0, len(self.html), self.FEED_SIZE):
+            parser.feed(self.html[i:i + self.FEED_SIZE])
+            while parser.paragraphs:
+                yield parser.paragraphs.popleft()
+        parser.close()
+        while parser.paragraphs:
+            yield parser.paragraphs.popleft()
 
-        for i in range(1, len(paragraphs)):
+    def iter_conversation(self):
+        """
+        Yields the paragraphs following the first timestamp (after the first paragraph), leaving out all timestamps.
+        Without such a timestamp the whole document is the conversation.
+        """
+        paragraphs = self.iter_paragraphs()
+        preamble = []
+        for i, paragraph in enumerate(paragraphs):
+            preamble.append(paragraph)
             try:
-                if paragraphs[i].get_text().split()[0].count(':') == 2:
-                    initial_time_index = i
+                if i >= 1 and _is_timestamp(paragraph[0]):
+                    preamble = []
                     break
             except Exception:
                 continue
 
-        for i in range(initial_time_index + 1, len(paragraphs)):
-            if paragraphs[i].get_text().split()[0].count(':') == 2:
-                continue
+        for text, is_bold in itertools.chain(preamble, paragraphs):
+            if not _is_timestamp(text):
+                yield text, is_bold
+
+    def iter_ques_ans(self):
+        """
+        Yields (question, answer) pairs. Questions are bold, answers are not; a paragraph in the same style as the
+        previous one continues its turn. The speaker name is removed from the beginning of each turn.
+        """
+        expected = 1
+        turns = []
+        for text, is_bold in self.iter_conversation():
+            if is_bold == expected:
+                if len(turns) == 2:
+                    yield _ques_ans(turns)
+                    turns = []
+                turns.append(text)
+                expected ^= 1
             else:
-                self.processed_html += str(paragraphs[i])
+                turns[len(turns) - 1] = turns[len(turns) - 1] + ' ' + text
+        if turns:
+            yield _ques_ans(turns)
+
+    def process_html(self):
+        # Kept for compatibility: extract_ques_ans() reads the document in a single pass
+        pass
 
     def extract_ques_ans(self):
-        soup = BeautifulSoup(self.processed_html, 'html.parser')
+        self.ques_ans = list(self.iter_ques_ans())
+        return self.ques_ans
 
-        for paragraph in soup.find_all('p'):
-            if paragraph.get_text().split()[0].count(':') == 2:
-                paragraph.extract()
 
-        paragraphs = soup.find_all('p')
-        checker = []
+class _ParagraphParser(HTMLParser):
+    """
+    Collects the text of each <p> element of mammoth's output, and whether it contains <strong> text.
+    """
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.paragraphs = deque()
+        self.text = None
+        self.is_bold = 0
 
-        for paragraph in paragraphs:
-            if paragraph.find('strong') is not None:
-                checker.append(1)
-            else:
-                checker.append(0)
+    def handle_starttag(self, tag, attrs):
+        if tag == 'p':
+            self.text = []
+            self.is_bold = 0
+        elif tag == 'strong' and self.text is not None:
+            self.is_bold = 1
 
-        expected = 1
-        temp_list = []
-        for i in range(len(paragraphs)):
-            if checker[i] == expected:
-                temp_list.append(paragraphs[i].get_text())
-                expected ^= 1
-            else:
-                temp_list[len(temp_list) - 1] = temp_list[len(temp_list) - 1] + ' ' + paragraphs[i].get_text()
+    def handle_endtag(self, tag):
+        if tag == 'p' and self.text is not None:
+            self.paragraphs.append((''.join(self.text), self.is_bold))
+            self.text = None
 
-        for i in range(0, len(temp_list), 2):
-            ques = temp_list[i].replace(temp_list[i].split()[0], '').strip()
-            if i + 1 == len(temp_list):
-                ans = ''
-            else:
-                ans = temp_list[i + 1].replace(temp_list[i + 1].split()[0], '').strip()
+    def handle_data(self, data):
+        if self.text is not None:
+            self.text.append(data)
 
-            self.ques_ans.append((ques, ans))
 
-        return self.ques_ans
+def _is_timestamp(text):
+    return text.split()[0].count(':') == 2
+
+
+def _ques_ans(turns):
+    ques = turns[0].replace(turns[0].split()[0], '').strip()
+    if len(turns) == 1:
+        ans = ''
+    else:
+        ans = turns[1].replace(turns[1].split()[0], '').strip()
+    return ques, ans
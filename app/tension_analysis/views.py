@@ -1,11 +1,21 @@
+import contextlib
 import csv
+import io
 import json
+import posixpath
+import shutil
 import traceback
+import uuid
+import zipfile
 
-from flask import Blueprint, current_app, g, redirect, render_template, request, send_file, url_for
+from flask import Blueprint, current_app, g, make_response, redirect, render_template, request, send_file, url_for
 
 import global_config
-from storage import CannotOpen, CannotSave, add_to_queue, open_user_file
+import metrics
+from storage import (
+    CannotOpen, CannotSave, ResultIndex, add_to_queue, open_user_file, read_batch, read_progress, read_worker_metrics,
+    remove_user_file, user_file_path, write_progress
+)
 
 from .decorators import ensure_user_cookie
 from .preprocessing import Preprocessor
@@ -13,24 +23,125 @@ from .preprocessing import Preprocessor
 views = Blueprint('views', __name__)
 
 
+def _read_progress(user_id):
+    """
+    Returns (percentage, progress) where progress is the dict from storage.read_progress and percentage is:
+      -1:   No previous report
+      0:    Scheduled
+      1-99: In progress
+      100:  Done
+      Error message
+    """
+    try:
+        progress = read_progress(user_id)
+    except CannotOpen:
+        return -1, {}
+    if 'error' in progress:
+        return progress['error'], progress
+    if progress.get('stage') == 'batch':
+        progress = _batch_progress(user_id)
+    elif 'transcripts_total' in progress:
+        # Link the reports of the transcripts of a combined batch
+        progress['transcripts'] = _batch_progress(user_id)['transcripts']
+    return progress.get('percentage', 0), progress
+
+
+def _batch_progress(user_id):
+    """
+    The jobs of the transcripts of a batch report their own progress until the last one combines their results.
+    Returns the progress of the batch with its 'transcripts', each with the 'percentage' of its job.
+    """
+    try:
+        transcripts = read_batch(user_id)
+    except CannotOpen:
+        transcripts = []
+    done = 0
+    total_percentage = 0
+    for transcript in transcripts:
+        transcript['percentage'], _ = _read_progress(transcript['job_id'])
+        if isinstance(transcript['percentage'], str) or transcript['percentage'] == 100:
+            done += 1
+            total_percentage += 100
+        elif transcript['percentage'] > 0:
+            total_percentage += transcript['percentage']
+
+    percentage = 0
+    if total_percentage > 0:
+        percentage = max(1, min(99, total_percentage // len(transcripts)))
+    return {
+        'percentage': percentage,
+        'stage': 'batch',
+        'transcripts_done': done,
+        'transcripts_total': len(transcripts),
+        'transcripts': transcripts,
+    }
+
+
+def _is_zip(fileobj):
+    return fileobj.filename.lower().endswith('.zip')
+
+
+def _uploaded_transcripts(files, stack):
+    """
+    Returns (file name, save function) for every uploaded transcript, taking the .docx files out of ZIP archives. A
+    save function copies the transcript to the given file object. The archives stay open until `stack`, an ExitStack,
+    is closed.
+    """
+    transcripts = []
+    for fileobj in files:
+        if not _is_zip(fileobj):
+            transcripts.append((fileobj.filename, fileobj.save))
+            continue
+        archive = stack.enter_context(zipfile.ZipFile(fileobj.stream))
+        for info in archive.infolist():
+            name = posixpath.basename(info.filename)
+            if info.is_dir() or info.filename.startswith('__MACOSX/') or name.startswith('.') or \
+               not name.lower().endswith('.docx'):
+                continue
+
+            def save(f, info=info, archive=archive):
+                with archive.open(info) as member:
+                    shutil.copyfileobj(member, f)
+            transcripts.append((name, save))
+    return transcripts
+
+
+def _save_batch(user_id, files):
+    """
+    Stores every uploaded transcript as a job of its own, saves the batch of the user and queues the jobs. The worker
+    extracts the question-answer pairs of each transcript. Raises ValueError with a message for the user if the upload
+    cannot be a batch.
+    """
+    with contextlib.ExitStack() as stack:
+        uploads = _uploaded_transcripts(files, stack)
+        if not uploads:
+            raise ValueError('No .docx transcript found in the upload.')
+        if len(uploads) > global_config.BATCH_MAX_TRANSCRIPTS:
+            raise ValueError(
+                'Please upload at most {} transcripts at once.'.format(global_config.BATCH_MAX_TRANSCRIPTS))
+
+        transcripts = []
+        for name, save in uploads:
+            job_id = uuid.uuid4().hex
+            with open_user_file(job_id, 'upload', mode='wb') as f:
+                save(f)
+            with open_user_file(job_id, 'parent', mode='w') as f:
+                json.dump({'parent': user_id}, f)
+            write_progress(job_id, {'percentage': 0, 'stage': 'scheduled'})
+            transcripts.append({'name': name, 'job_id': job_id})
+
+    with open_user_file(user_id, 'batch', mode='w') as f:
+        json.dump(transcripts, f)
+    write_progress(user_id, {'percentage': 0, 'stage': 'batch'})
+    for transcript in transcripts:
+        add_to_queue(transcript['job_id'])
+
+
 @views.route('/', methods=['GET', 'POST'])
 @ensure_user_cookie
 def welcome():
     errors = {}
-    # Percentage:
-    #   -1:   No previous report
-    #   0:    Scheduled
-    #   1-99: In progress
-    #   100:  Done
-    #   Error message
-    try:
-        with open_user_file(g.user_id, 'percentage', mode='r') as f:
-            percentage = f.read()
-            percentage = int(percentage)
-    except CannotOpen:
-        percentage = -1
-    except ValueError:
-        pass  # leave percentage as a string
+    percentage, progress = _read_progress(g.user_id)
 
     if isinstance(percentage, str):
         status = 'FAILED'
@@ -52,23 +163,44 @@ def welcome():
         message = 'unknown status {}'.format(percentage)
 
     if request.method == 'POST':
-        if 'file' not in request.files:
+        files = [f for f in request.files.getlist('file') if f.filename]
+        if not files:
             errors['file'] = 'Please upload a file.'
-        else:
-            input_fileobj = request.files['file']
+        elif len(files) > 1 or _is_zip(files[0]):
             try:
-                processor = Preprocessor(input_fileobj)
-                processor.process_html()
-                questions_answers = processor.extract_ques_ans()
+                _save_batch(g.user_id, files)
+            except CannotSave as e:
+                errors['file'] = 'Cannot initialize output file. Please report with code: {}.'.format(g.user_id[:6])
+                current_app.logger.error(traceback.format_exc())
+            except ValueError as e:
+                errors['file'] = str(e)
             except Exception as e:
                 errors['file'] = 'Your file is not in the right format. Please provide valid file.'
                 current_app.logger.error(traceback.format_exc())
             else:
+                return redirect(url_for('views.result'))
+        else:
+            input_fileobj = files[0]
+            questions_answers = None
+            if not global_config.PARSE_IN_WORKER:
+                try:
+                    questions_answers = list(Preprocessor(input_fileobj).iter_ques_ans())
+                except Exception as e:
+                    errors['file'] = 'Your file is not in the right format. Please provide valid file.'
+                    current_app.logger.error(traceback.format_exc())
+
+            if not errors:
                 try:
-                    with open_user_file(g.user_id, 'input', mode='w') as f1:
-                        with open_user_file(g.user_id, 'percentage', mode='w') as f2:
+                    if questions_answers is None:
+                        # The worker extracts the question-answer pairs, reporting format errors as the job status
+                        with open_user_file(g.user_id, 'upload', mode='wb') as f1:
+                            input_fileobj.save(f1)
+                    else:
+                        remove_user_file(g.user_id, 'upload')
+                        with open_user_file(g.user_id, 'input', mode='w') as f1:
                             json.dump(questions_answers, f1)
-                            f2.write('0')
+                    remove_user_file(g.user_id, 'batch')
+                    write_progress(g.user_id, {'percentage': 0, 'stage': 'scheduled'})
                     add_to_queue(g.user_id)
                 except CannotSave as e:
                     errors['file'] = 'Cannot initialize output file. Please report with code: {}.'.format(g.user_id[:6])
@@ -79,19 +211,61 @@ def welcome():
     return render_template('welcome.html', errors=errors, status=status, message=message)
 
 
+def _committed_text(f):
+    """
+    The worker appends the partial result in whole chunks. Drop whatever follows the last line break in case a chunk
+    is being written right now.
+    """
+    text = f.read()
+    return text[:text.rfind('\n') + 1]
+
+
+def _read_indexed_page(f, index, skip, take):
+    """
+    Returns the rows `skip` to `skip + take` of the result file object `f`, seeking straight to them with the row index.
+    """
+    end = min(skip + take, index.rows)
+    if skip >= end:
+        return []
+    start_offset, _ = index[skip]
+    end_offset, _ = index[end]
+    f.buffer.seek(start_offset)
+    # Translate line breaks like the text mode file would
+    text = io.StringIO(f.buffer.read(end_offset - start_offset).decode(f.encoding), newline=None)
+    return list(csv.reader(text, delimiter=global_config.CSV_DELIMITER, quotechar=global_config.CSV_QUOTECHAR))
+
+
+def _report_id():
+    """
+    Returns the user_id of the requested report: the user's own, or with ?transcript=i the report of the i-th transcript
+    of the user's batch. Returns None if there is no such transcript.
+    """
+    transcript = request.args.get('transcript')
+    if transcript is None:
+        return g.user_id
+    try:
+        i = int(transcript)
+        assert i >= 0
+        return read_batch(g.user_id)[i]['job_id']
+    except Exception:
+        return None
+
+
 @views.route('/result/')
 @ensure_user_cookie
 def result():
-    try:
-        with open_user_file(g.user_id, 'percentage', mode='r') as f:
-            percentage = f.read()
-            percentage = int(percentage)
-    except CannotOpen:
-        percentage = -1
-    except ValueError:
-        pass  # leave percentage as a string
-    if percentage != 100:
-        return render_template('wait_for_result.html', percentage=percentage)
+    report_id = _report_id()
+    if report_id is None:
+        return "Requested report does not exist or has expired.", 404
+    transcript = request.args.get('transcript')
+
+    percentage, progress = _read_progress(report_id)
+    if percentage == 100:
+        file_code = 'result'
+    elif isinstance(percentage, int) and 1 <= percentage <= 99:
+        file_code = 'partial_result'
+    else:
+        return render_template('wait_for_result.html', percentage=percentage, progress=progress)
 
     try:
         skip = int(request.args.get('skip'))
@@ -110,27 +284,53 @@ def result():
     lines = []
     has_previous_page = (skip > 0)
     has_next_page = False
+    total_rows = tension_rows = None
 
     try:
-        with open_user_file(g.user_id, 'result', mode='r') as f:
-            reader = csv.reader(f, delimiter=global_config.CSV_DELIMITER, quotechar=global_config.CSV_QUOTECHAR)
-            next(reader)  # skip header
+        with open_user_file(report_id, file_code, mode='r') as f:
+            try:
+                with open_user_file(report_id, file_code + '_index', mode='rb') as f_index:
+                    index = ResultIndex(f_index)
+                    if index.rows >= 0:
+                        # The index only holds rows already in the file
+                        rows = _read_indexed_page(f, index, skip, take)
+                        has_next_page = end < index.rows
+                        total_rows = index.rows
+                        _, tension_rows = index[index.rows]
+            except CannotOpen:
+                pass  # Written without an index
 
-            for i, line in enumerate(reader):
-                if skip <= i < end:
+            if total_rows is not None:
+                for i, line in enumerate(rows, skip):
                     try:
                         lines.append([i + 1] + line[:3])
                     except Exception:
                         lines.append(['ERROR', '', '', ''])
-                elif i == end:
-                    has_next_page = True
-                    break
+            else:
+                if file_code == 'partial_result':
+                    f = io.StringIO(_committed_text(f))
+                reader = csv.reader(f, delimiter=global_config.CSV_DELIMITER, quotechar=global_config.CSV_QUOTECHAR)
+                next(reader, None)  # skip header
+
+                for i, line in enumerate(reader):
+                    if skip <= i < end:
+                        try:
+                            lines.append([i + 1] + line[:3])
+                        except Exception:
+                            lines.append(['ERROR', '', '', ''])
+                    elif i == end:
+                        has_next_page = True
+                        break
     except CannotOpen as e:
+        if file_code == 'partial_result':
+            # The worker has not started writing yet, or has just finished
+            return render_template('wait_for_result.html', percentage=percentage, progress=progress)
         return "Requested report does not exist or has expired.", 404
 
     return render_template(
         'result.html',
-        lines=lines, skip=skip, take=take,
+        lines=lines, skip=skip, take=take, percentage=percentage, progress=progress, transcript=transcript,
+        total_rows=total_rows, tension_rows=tension_rows,
         has_previous_page=has_previous_page, has_next_page=has_next_page
     )
 
@@ -138,10 +338,45 @@ def result():
 @views.route('/result.csv')
 @ensure_user_cookie
 def result_csv():
+    report_id = _report_id()
+    if report_id is None:
+        return "Requested report does not exist or has expired.", 404
+
+    # The result of an earlier job stays until the new one replaces it: only serve it once the new job is done
+    percentage, _ = _read_progress(report_id)
+    if percentage == 100:
+        try:
+            with open_user_file(report_id, 'result', mode='rb') as f:
+                path = f.name
+        except Exception:
+            return "Requested report does not exist or has expired.", 404
+        if global_config.ACCEL_REDIRECT_PREFIX:
+            # nginx sends the file, answering Range and conditional requests, gzip-compressed if available
+            response = make_response('')
+            response.mimetype = 'text/csv'
+            response.headers['X-Accel-Redirect'] = '{}{}'.format(
+                global_config.ACCEL_REDIRECT_PREFIX, user_file_path(report_id, 'result'))
+            return response
+        return send_file(path, mimetype='text/csv', attachment_filename='report.csv', conditional=True)
+
+    if not (isinstance(percentage, int) and 1 <= percentage <= 99):
+        return "Requested report does not exist or has expired.", 404
+    # While the report is in progress, download the rows written so far
     try:
-        # Don't use with statement because we need to keep the file object open.
-        f = open_user_file(g.user_id, 'result', mode='rb').get_file_object()
+        with open_user_file(report_id, 'partial_result', mode='r') as f:
+            partial = io.BytesIO(_committed_text(f).encode(f.encoding))
     except Exception:
         return "Requested report does not exist or has expired.", 404
     else:
-        return send_file(f, mimetype='text/csv', attachment_filename='report.csv')
+        return send_file(partial, mimetype='text/csv', attachment_filename='report-partial.csv')
+
+
+@views.route('/metrics')
+def worker_metrics():
+    """
+    Stage timers and counters of all jobs of all workers so far, in the Prometheus text format.
+    """
+    response = make_response(metrics.render_prometheus(read_worker_metrics()))
+    response.mimetype = 'text/plain'
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return response
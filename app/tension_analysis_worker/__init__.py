@@ -2,45 +2,143 @@ import json
 import logging
 import traceback
 
-from storage import CannotOpen, CannotSave, open_user_file
+import global_config
+import metrics
+from storage import (
+    CannotOpen, CannotSave, open_user_file, remove_user_file, rename_user_file, read_worker_totals, write_progress,
+    write_worker_metrics
+)
 
-from .process import tension_analysis
+from .batch import complete_batch
+from .profiling import JobProfiler
+from .progress import ProgressReporter
 
 
 logger = logging.getLogger(__name__)
 
+# Metrics of all jobs run in the worker slot of this process, read when its first job ends
+_totals = None
+
+
+class _InvalidUpload(Exception):
+    pass
+
 
 def task_tension_analysis(user_id):
+    with metrics.job() as job_metrics:
+        with JobProfiler() as profiler, metrics.timer('job'):
+            succeeded = _analyze(user_id)
+        profiler.save(user_id)
+        job_metrics.count('jobs')
+        if not succeeded:
+            job_metrics.count('jobs_failed')
+    _save_metrics(user_id, job_metrics)
+
+    # The last transcript of a batch to end combines the results of the batch
+    complete_batch(user_id)
+
+
+def _analyze(user_id):
+    """
+    Runs the job, reporting its progress or error. Returns whether it succeeded.
+    """
     # Import inline to avoid web thread loading all dependencies
+    from .process import compress_result, tension_analysis
+
+    # nginx would serve a stale copy next to the new result
+    remove_user_file(user_id, 'result_gzip')
+
+    progress = ProgressReporter(user_id)
     try:
-        with open_user_file(user_id, 'input', mode='r') as f:
-            questions_answers = json.load(f)
+        with metrics.timer('read_input'):
+            questions_answers = _read_input(user_id, progress)
+    except _InvalidUpload:
+        _write_error(user_id, 'Your file is not in the right format. Please provide valid file.')
+        logger.error(traceback.format_exc())
+        return False
     except CannotOpen:
         _write_error(user_id, 'Cannot open input file. Please report with code {}'.format(user_id[:6]))
         logger.error(traceback.format_exc())
+        return False
     except Exception as e:
         _write_error(user_id, 'Cannot read input file. Please report with code {}'.format(user_id[:6]))
         logger.error(traceback.format_exc())
+        return False
     else:
-        def update_percentage(percentage):
-            with open_user_file(user_id, 'percentage', mode='w') as f1:
-                f1.write(str(percentage))
         try:
-            with open_user_file(user_id, 'result', mode='w') as f2:
-                tension_analysis(questions_answers, f2, update_percentage)
+            with open_user_file(user_id, 'result', mode='w') as f2, \
+                    open_user_file(user_id, 'result_index', mode='wb') as f3:
+                tension_analysis(questions_answers, f2, progress, f3)
         except CannotSave:
             _write_error(user_id, 'Cannot initialize output file. Please report with code {}'.format(user_id[:6]))
             logger.error(traceback.format_exc())
+            return False
         except Exception as e:
             _write_error(
                 user_id,
                 'Unexpected error during processing: {}. '
                 'Please report with code {}'.format(e, user_id[:6]))
             logger.error(traceback.format_exc())
+            return False
         else:
-            update_percentage(100)
+            if global_config.RESULT_GZIP:
+                with metrics.timer('result_compress'):
+                    compress_result(user_id)
+            progress.done()
+            return True
+
+
+def _save_metrics(user_id, job_metrics):
+    """
+    Saves the metrics of the job next to its results and adds them to the totals of the worker slot of this process.
+    """
+    global _totals
+    if _totals is None:
+        # Carry on with the totals of the worker which this process replaces
+        _totals = read_worker_totals()
+    _totals.merge(job_metrics)
+    report = job_metrics.to_dict()
+    report['cache_hit_rates'] = metrics.hit_rates(report['counters'])
+    try:
+        with open_user_file(user_id, 'metrics', mode='w') as f:
+            json.dump(report, f, indent=2)
+        write_worker_metrics(_totals.to_dict())
+    except Exception:
+        logger.warning(traceback.format_exc())
+
+    slowest = sorted(report['timers'].items(), key=lambda item: -item[1]['seconds'])
+    logger.info('Job {} metrics: {}'.format(user_id, ', '.join(
+        '{} {:.2f}s'.format(name, timer['seconds']) for name, timer in slowest[:6])))
+
+
+def _read_input(user_id, progress):
+    """
+    Returns the question-answer pairs of the job. An upload stored as is by the web app is parsed first, replacing
+    the input of any earlier job. Raises _InvalidUpload if it is not a valid transcript.
+    """
+    # Move the upload aside first, so that an upload stored again while it is parsed is left for the next job
+    try:
+        rename_user_file(user_id, 'upload', 'parsing_upload')
+    except CannotOpen:
+        with open_user_file(user_id, 'input', mode='r') as f:
+            return json.load(f)
+
+    # Import inline to avoid loading mammoth for jobs parsed by the web app
+    from tension_analysis.preprocessing import Preprocessor
+
+    try:
+        progress.update(percentage=1, stage='parsing')
+        with open_user_file(user_id, 'parsing_upload', mode='rb') as f:
+            try:
+                questions_answers = list(Preprocessor(f).iter_ques_ans())
+            except Exception as e:
+                raise _InvalidUpload from e
+        with open_user_file(user_id, 'input', mode='w') as f:
+            json.dump(questions_answers, f)
+    finally:
+        remove_user_file(user_id, 'parsing_upload')
+    return questions_answers
 
 
 def _write_error(user_id, error_string):
-    with open_user_file(user_id, 'percentage', mode='w') as f:
-        f.write(error_string)
+    write_progress(user_id, {'error': error_string})
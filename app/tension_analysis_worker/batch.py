@@ -0,0 +1,90 @@
+import csv
+import json
+import logging
+import traceback
+
+import global_config
+from storage import (
+    CannotOpen, create_user_file, open_user_file, read_batch, read_progress, remove_user_file, write_progress
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+def complete_batch(job_id):
+    """
+    Called when the job of a transcript ends. Once all transcripts of its batch have ended, combines their results into
+    the result of the batch. The last jobs may end at the same time on several workers: the batch lock elects the one
+    which combines.
+    """
+    try:
+        with open_user_file(job_id, 'parent', mode='r') as f:
+            user_id = json.load(f)['parent']
+        transcripts = read_batch(user_id)
+    except CannotOpen:
+        return  # Not part of a batch
+
+    if job_id not in [transcript['job_id'] for transcript in transcripts]:
+        return  # The user submitted a new batch since
+    if not all(_has_ended(transcript['job_id']) for transcript in transcripts):
+        return
+    # Lock in the folder of a job, so that every batch has its own lock
+    if not create_user_file(transcripts[0]['job_id'], 'batch_lock'):
+        return
+
+    try:
+        failed = _combine_results(user_id, transcripts)
+    except Exception as e:
+        write_progress(user_id, {
+            'error': 'Cannot combine the results of the transcripts: {}. '
+                     'Please report with code {}'.format(e, user_id[:6])
+        })
+        logger.error(traceback.format_exc())
+    else:
+        write_progress(user_id, {
+            'percentage': 100,
+            'stage': 'done',
+            'transcripts_total': len(transcripts),
+            'transcripts_failed': failed,
+        })
+
+
+def _has_ended(job_id):
+    try:
+        progress = read_progress(job_id)
+    except CannotOpen:
+        return False
+    return 'error' in progress or progress.get('percentage') == 100
+
+
+def _combine_results(user_id, transcripts):
+    """
+    Writes the rows of all transcripts, in the order of the batch, into the result of the user. Returns the number of
+    transcripts without a result.
+    """
+    # Import inline to avoid web thread loading all dependencies
+    from .process import ChunkedWriter, compress_result
+
+    remove_user_file(user_id, 'result_gzip')
+    failed = 0
+    with open_user_file(user_id, 'result', mode='w') as f, \
+            open_user_file(user_id, 'result_index', mode='wb') as f_index:
+        writer = ChunkedWriter(f, f_index)
+        writer.writerow(['Content', 'Role', 'Predicted Label', 'Transcript'])
+        for transcript in transcripts:
+            try:
+                with open_user_file(transcript['job_id'], 'result', mode='r') as f_transcript:
+                    reader = csv.reader(
+                        f_transcript, delimiter=global_config.CSV_DELIMITER, quotechar=global_config.CSV_QUOTECHAR)
+                    next(reader, None)  # skip header
+                    for row in reader:
+                        writer.writerow(row + [transcript['name']])
+            except CannotOpen:
+                failed += 1
+            writer.flush()
+        writer.flush()
+
+    if global_config.RESULT_GZIP:
+        compress_result(user_id)
+    return failed
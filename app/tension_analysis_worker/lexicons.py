@@ -0,0 +1,400 @@
+"""
+Lexicons used by the emotion and hedge detection helpers.
+
+Parsing the text files takes a while, so they are also compiled into a single binary snapshot which is memory-mapped
+at startup. The snapshot records a hash of every source file and is ignored (then rebuilt) once any of them changes.
+
+Snapshot layout: 8 bytes magic, 8 bytes header length, a JSON header, then the numeric tables as float64 arrays.
+"""
+from collections.abc import Mapping
+import csv
+import hashlib
+import json
+import logging
+import os
+import struct
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_MAGIC = b'TALEXSNP'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_PATH = 'lexicons/lexicons.snapshot'
+
+SOURCES = [
+    'lexicons/Ratings_Warriner_et_al.csv',
+    'lexicons/NRC-emotion-lexicon-wordlevel-v0.92.txt',
+    'lexicons/nrc_affect_intensity.txt',
+    'lexicons/NRC-Hashtag-Emotion-Lexicon-v0.2.txt',
+    'lexicons/BingLiu.txt',
+    'lexicons/mpqa.txt',
+    'lexicons/AFINN-en-165.txt',
+    'lexicons/stopwords.txt',
+    'lexicons/slangs.txt',
+    'lexicons/negated_words.txt',
+    'lexicons/emoticons.txt',
+    'resources/booster_words.txt',
+    'resources/cues.txt',
+    'resources/hedge_words.txt',
+    'resources/discourse_markers.txt',
+]
+
+EMOTIONS = ['anger', 'disgust', 'fear', 'joy', 'sadness', 'surprise']
+
+# Lexicons mapping words to a dict of floats (or a float), with their columns
+TABLES = {
+    'ratings': ['Valence', 'Arousal', 'Dominance'],
+    'nrc_emotion': EMOTIONS,
+    'nrc_affect_intensity': EMOTIONS,
+    'nrc_hashtag_emotion': EMOTIONS,
+    'afinn': None,
+}
+# Lexicons mapping words to strings
+MAPPINGS = ['bingliu_mpqa', 'slangs', 'negated']
+# Lists of words
+LISTS = ['stopwords', 'emoticons', 'boosters', 'cues', 'hedge_words', 'discourse_markers']
+
+
+class LexiconTable(Mapping):
+    """
+    Read-only dict-like view of a numeric lexicon stored as a matrix with one row per word. Values are dicts keyed by
+    column, or floats when there are no columns.
+    """
+    def __init__(self, words, columns, matrix):
+        self.words = words
+        self.columns = columns
+        self.matrix = matrix
+        self.index = dict(zip(words, range(len(words))))
+
+    @classmethod
+    def from_dict(cls, lexicon, columns):
+        words = list(lexicon)
+        if columns is None:
+            matrix = np.array([[lexicon[w]] for w in words], dtype='<f8').reshape(len(words), 1)
+        else:
+            matrix = np.array([[lexicon[w][c] for c in columns] for w in words], dtype='<f8').reshape(
+                len(words), len(columns))
+        return cls(words, columns, matrix)
+
+    def __getitem__(self, word):
+        row = self.matrix[self.index[word]]
+        if self.columns is None:
+            return float(row[0])
+        return {c: float(v) for c, v in zip(self.columns, row)}
+
+    def __contains__(self, word):
+        return word in self.index
+
+    def __iter__(self):
+        return iter(self.words)
+
+    def __len__(self):
+        return len(self.words)
+
+
+class FeatureTable(object):
+    """
+    Every word of the word lexicons mapped to a row of one dense matrix, laid out as the first 21 features of
+    emotion_helpers.feature_generation:
+
+      0-2: Warriner et al., 3-5: VADER (always 0 here), 6-11: NRC Emotion, 12-17: NRC Affect Intensity, 18: AFINN,
+      19-20: BingLiu and MPQA positive/negative
+
+    and the same for NRC Hashtag Emotion. Row 0 is all zeros and stands for unknown words.
+    """
+    WORD_FEATURES = 21
+
+    def __init__(self, ratings, nrc_emotion, nrc_affect_intensity, afinn, bingliu_mpqa, nrc_hashtag_emotion):
+        words = set(ratings) | set(nrc_emotion) | set(nrc_affect_intensity) | set(afinn) | set(bingliu_mpqa)
+        self.word_index = {w: i for i, w in enumerate(sorted(words), 1)}
+        self.word_matrix = np.zeros((len(words) + 1, self.WORD_FEATURES))
+        _fill(self.word_matrix, self.word_index, ratings, TABLES['ratings'], 0)
+        _fill(self.word_matrix, self.word_index, nrc_emotion, EMOTIONS, 6)
+        _fill(self.word_matrix, self.word_index, nrc_affect_intensity, EMOTIONS, 12)
+        _fill(self.word_matrix, self.word_index, afinn, None, 18)
+        for word, polarity in bingliu_mpqa.items():
+            self.word_matrix[self.word_index[word], 19 if polarity == 'positive' else 20] = 1
+
+        self.hashtag_index = {w: i for i, w in enumerate(nrc_hashtag_emotion, 1)}
+        self.hashtag_matrix = np.zeros((len(self.hashtag_index) + 1, len(EMOTIONS)))
+        _fill(self.hashtag_matrix, self.hashtag_index, nrc_hashtag_emotion, EMOTIONS, 0)
+
+    def word_features(self, texts):
+        """
+        Returns the sum of the word rows of every tokenized text, as a (len(texts), 21) array.
+        """
+        return sum_rows(self.word_matrix, [[self.word_index.get(w, 0) for w in text] for text in texts])
+
+    def hashtag_features(self, hashtags):
+        return sum_rows(self.hashtag_matrix, [[self.hashtag_index.get(w, 0) for w in words] for words in hashtags])
+
+
+def _fill(matrix, index, lexicon, columns, start):
+    rows = [index[w] for w in lexicon]
+    if not rows:
+        return
+    if isinstance(lexicon, LexiconTable):
+        values = lexicon.matrix
+    elif columns is None:
+        values = np.array([[lexicon[w]] for w in lexicon])
+    else:
+        values = np.array([[lexicon[w][c] for c in columns] for w in lexicon])
+    matrix[rows, start:start + values.shape[1]] = values
+
+
+def sum_rows(matrix, indices):
+    """
+    Returns one sum of rows of `matrix` per list of row indices. Rows are added one at a time, in order, across all
+    lists at once, so that every sum is exactly what accumulating the rows in a Python loop gives.
+    """
+    length = max([len(rows) for rows in indices] + [0])
+    padded = np.zeros((len(indices), length), dtype=np.intp)  # Padding points at the zero row
+    for i, rows in enumerate(indices):
+        padded[i, :len(rows)] = rows
+    total = np.zeros((len(indices), matrix.shape[1]))
+    for j in range(length):
+        total += matrix[padded[:, j]]
+    return total
+
+
+def load_lexicons(data_root):
+    """
+    Returns all lexicons in a dict keyed by name. Uses the snapshot under data_root if it is up to date, otherwise
+    parses the text files and tries to refresh the snapshot.
+    """
+    path = os.path.join(data_root, SNAPSHOT_PATH)
+    try:
+        return load_snapshot(path, data_root)
+    except FileNotFoundError:
+        logger.info('No lexicon snapshot found. Parsing text files...')
+    except Exception as e:
+        logger.info('Ignoring lexicon snapshot: {}. Parsing text files...'.format(e))
+
+    lexicons = load_from_text(data_root)
+    try:
+        build_snapshot(path, data_root, lexicons)
+    except OSError as e:
+        logger.warning('Cannot save lexicon snapshot: {}'.format(e))
+    return lexicons
+
+
+def source_hashes(data_root):
+    hashes = {}
+    for source in SOURCES:
+        with open(os.path.join(data_root, source), 'rb') as f:
+            hashes[source] = hashlib.sha256(f.read()).hexdigest()
+    return hashes
+
+
+def build_snapshot(path, data_root, lexicons=None):
+    if lexicons is None:
+        lexicons = load_from_text(data_root)
+
+    header = {
+        'version': SNAPSHOT_VERSION,
+        'sources': source_hashes(data_root),
+        'tables': {},
+        'mappings': {name: dict(lexicons[name]) for name in MAPPINGS},
+        'lists': {name: list(lexicons[name]) for name in LISTS},
+    }
+    matrices = []
+    offset = 0
+    for name, columns in sorted(TABLES.items()):
+        table = lexicons[name]
+        if not isinstance(table, LexiconTable):
+            table = LexiconTable.from_dict(table, columns)
+        header['tables'][name] = {
+            'words': table.words, 'columns': columns, 'offset': offset, 'shape': table.matrix.shape
+        }
+        matrices.append(np.ascontiguousarray(table.matrix, dtype='<f8'))
+        offset += matrices[-1].nbytes
+
+    header_bytes = json.dumps(header).encode('utf-8')
+    # Pad so that the arrays start 8-byte aligned
+    header_bytes += b' ' * (-(len(SNAPSHOT_MAGIC) + 8 + len(header_bytes)) % 8)
+
+    # Write next to the destination and rename, so concurrent workers never read a half-written snapshot
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(SNAPSHOT_MAGIC)
+            f.write(struct.pack('<Q', len(header_bytes)))
+            f.write(header_bytes)
+            for matrix in matrices:
+                f.write(matrix.tobytes())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+    logger.info('Saved lexicon snapshot to {}'.format(path))
+
+
+def load_snapshot(path, data_root):
+    with open(path, 'rb') as f:
+        if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+            raise ValueError('not a lexicon snapshot')
+        header_length, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_length).decode('utf-8'))
+    data_offset = len(SNAPSHOT_MAGIC) + 8 + header_length
+
+    if header['version'] != SNAPSHOT_VERSION:
+        raise ValueError('version {} is not {}'.format(header['version'], SNAPSHOT_VERSION))
+    if header['sources'] != source_hashes(data_root):
+        raise ValueError('source files changed')
+
+    lexicons = {}
+    for name, table in header['tables'].items():
+        matrix = np.memmap(
+            path, dtype='<f8', mode='r', offset=data_offset + table['offset'], shape=tuple(table['shape']))
+        lexicons[name] = LexiconTable(table['words'], table['columns'], matrix)
+    lexicons.update(header['mappings'])
+    lexicons.update(header['lists'])
+    return lexicons
+
+
+def load_from_text(data_root):
+    lexicons = {
+        'bingliu_mpqa': {},
+        'nrc_emotion': {},
+        'nrc_affect_intensity': {},
+        'nrc_hashtag_emotion': {},
+        'afinn': {},
+        'ratings': {},
+        'stopwords': [],
+        'slangs': {},
+        'negated': {},
+        'emoticons': [],
+        'boosters': [],
+        'cues': [],
+        'hedge_words': [],
+        'discourse_markers': [],
+    }
+    load_emotion_lexicons(data_root, **lexicons)
+    load_hedge_lexicons(data_root, **lexicons)
+    return lexicons
+
+
+def load_emotion_lexicons(data_root, ratings, nrc_emotion, nrc_affect_intensity, nrc_hashtag_emotion, bingliu_mpqa,
+                          afinn, stopwords, slangs, negated, emoticons, **kwargs):
+    # Ratings by Warriner et al. (2013)
+    with open(os.path.join(data_root, 'lexicons/Ratings_Warriner_et_al.csv'), 'r') as f:
+        reader = csv.reader(f)
+        rows = list(reader)
+    for i in range(1, len(rows)):
+        # Normalize values
+        valence = (float(rows[i][2]) - 1.0)/(9.0-1.0)
+        arousal = (float(rows[i][5]) - 1.0)/(9.0-1.0)
+        dominance = (float(rows[i][8]) - 1.0)/(9.0-1.0)
+        ratings[rows[i][1]] = {"Valence": valence, "Arousal": arousal, "Dominance": dominance}
+
+    # NRC Emotion Lexicon (2014)
+    with open(os.path.join(data_root, 'lexicons/NRC-emotion-lexicon-wordlevel-v0.92.txt'), 'r') as f:
+        f.readline()
+        for line in f:
+            splitted = line.strip().split('\t')
+            if splitted[0] not in nrc_emotion:
+                nrc_emotion[splitted[0]] = {
+                    'anger': float(splitted[1]),
+                    'disgust': float(splitted[3]),
+                    'fear': float(splitted[4]),
+                    'joy': float(splitted[5]),
+                    'sadness': float(splitted[8]),
+                    'surprise': float(splitted[9])
+                }
+
+    # NRC Affect Intensity (2018)
+    with open(os.path.join(data_root, 'lexicons/nrc_affect_intensity.txt'), 'r') as f:
+        f.readline()
+        for line in f:
+            splitted = line.strip().split('\t')
+            if splitted[0] not in nrc_affect_intensity:
+                nrc_affect_intensity[splitted[0]] = {
+                    'anger': float(splitted[1]),
+                    'disgust': float(splitted[3]),
+                    'fear': float(splitted[4]),
+                    'joy': float(splitted[5]),
+                    'sadness': float(splitted[8]),
+                    'surprise': float(splitted[9])
+                }
+
+    # NRC Hashtag Emotion Lexicon (2015)
+    with open(os.path.join(data_root, 'lexicons/NRC-Hashtag-Emotion-Lexicon-v0.2.txt'), 'r') as f:
+        f.readline()
+        for line in f:
+            splitted = line.strip().split('\t')
+            splitted[0] = splitted[0].replace('#', '')
+            if splitted[0] not in nrc_hashtag_emotion:
+                nrc_hashtag_emotion[splitted[0]] = {
+                    'anger': float(splitted[1]),
+                    'disgust': float(splitted[3]),
+                    'fear': float(splitted[4]),
+                    'joy': float(splitted[5]),
+                    'sadness': float(splitted[8]),
+                    'surprise': float(splitted[9])
+                }
+
+    # BingLiu (2004) and MPQA (2005)
+    with open(os.path.join(data_root, 'lexicons/BingLiu.txt'), 'r') as f:
+        for line in f:
+            splitted = line.strip().split('\t')
+            if splitted[0] not in bingliu_mpqa:
+                bingliu_mpqa[splitted[0]] = splitted[1]
+    with open(os.path.join(data_root, 'lexicons/mpqa.txt'), 'r') as f:
+        for line in f:
+            splitted = line.strip().split('\t')
+            if splitted[0] not in bingliu_mpqa:
+                bingliu_mpqa[splitted[0]] = splitted[1]
+
+    with open(os.path.join(data_root, 'lexicons/AFINN-en-165.txt'), 'r') as f:
+        for line in f:
+            splitted = line.strip().split('\t')
+            if splitted[0] not in afinn:
+                score = float(splitted[1])
+                normalized_score = (score - (-5)) / (5-(-5))
+                afinn[splitted[0]] = normalized_score
+
+    with open(os.path.join(data_root, 'lexicons/stopwords.txt'), 'r') as f:
+        for line in f:
+            stopwords.append(line.strip())
+
+    with open(os.path.join(data_root, 'lexicons/slangs.txt'), 'r') as f:
+        for line in f:
+            splitted = line.strip().split(',', 1)
+            slangs[splitted[0]] = splitted[1]
+
+    with open(os.path.join(data_root, 'lexicons/negated_words.txt'), 'r') as f:
+        for line in f:
+            splitted = line.strip().split(',', 1)
+            negated[splitted[0]] = splitted[1]
+
+    with open(os.path.join(data_root, 'lexicons/emoticons.txt'), 'r') as f:
+        for line in f:
+            emoticons.append(line.strip())
+
+
+def load_hedge_lexicons(data_root, boosters, cues, hedge_words, discourse_markers, **kwargs):
+    with open(os.path.join(data_root, "resources/booster_words.txt"), 'r') as f:
+        for line in f:
+            if '#' not in line.strip():
+                boosters.append(line.strip())
+
+    with open(os.path.join(data_root, "resources/cues.txt"), 'r') as f:
+        for line in f:
+            if '#' not in line.strip():
+                cues.append(line.strip())
+
+    with open(os.path.join(data_root, "resources/hedge_words.txt"), "r") as f:
+        for line in f:
+            if '#' in line:
+                continue
+            elif line.strip() != "":
+                hedge_words.append(line.strip())
+
+    with open(os.path.join(data_root, "resources/discourse_markers.txt"), "r") as f:
+        for line in f:
+            if '#' in line:
+                continue
+            elif line.strip() != "":
+                discourse_markers.append(line.strip())
@@ -1,14 +1,20 @@
-import csv
+from bisect import bisect_right
 import logging
+import os
 from pathlib import Path
 import pickle
 
 from keras.models import load_model
 from nltk.stem.wordnet import WordNetLemmatizer
+import requests
 from stanfordcorenlp import StanfordCoreNLP
 import tensorflow as tf
+from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
 
 import global_config
+import metrics
+
+from .lexicons import FeatureTable, load_lexicons
 
 
 logger = logging.getLogger(__name__)
@@ -30,6 +36,8 @@ __all__ = [
     'nrc_hashtag_emotion',
     'afinn',
     'ratings',
+    'feature_table',
+    'vader',
     'stopwords',
     'slangs',
     'negated',
@@ -41,170 +49,54 @@ __all__ = [
 ]
 
 
-# Pre-trained model
-logger.info('Loading pre-trained emotion recognition model...')
-
-# https://github.com/keras-team/keras/issues/2397#issuecomment-306687500
-model = load_model(str(DATA_ROOT / 'models/model.h5'))
-model._make_predict_function()
-graph = tf.get_default_graph()
+# Pre-trained model, loaded by load_emotion_model()
+model = None
+graph = None
 
-with open(DATA_ROOT / 'models/variables-slim.p', 'rb') as f:
-    lb, tokenizer_tweets, max_tweet_length, tokenizer_hash_emo, max_hash_emo_length = pickle.load(f)
 
-boosters = []
-with open(DATA_ROOT / "resources/booster_words.txt", 'r') as f:
-    for line in f:
-        if '#' not in line.strip():
-            boosters.append(line.strip())
-
-cues = []
-with open(DATA_ROOT / "resources/cues.txt", 'r') as f:
-    for line in f:
-        if '#' not in line.strip():
-            cues.append(line.strip())
-
-
-# Emotion lexicons
-logger.info('Loading emotion lexicons...')
-
-bingliu_mpqa = {}
-nrc_emotion = {}
-nrc_affect_intensity = {}
-nrc_hashtag_emotion = {}
-afinn = {}
-ratings = {}
-stopwords = []
-slangs = {}
-negated = {}
-emoticons = []
-
-
-def load_emotion_lexicons():
-    # Ratings by Warriner et al. (2013)
-    with open(DATA_ROOT / 'lexicons/Ratings_Warriner_et_al.csv', 'r') as f:
-        reader = csv.reader(f)
-        rows = list(reader)
-    for i in range(1, len(rows)):
-        # Normalize values
-        valence = (float(rows[i][2]) - 1.0)/(9.0-1.0)
-        arousal = (float(rows[i][5]) - 1.0)/(9.0-1.0)
-        dominance = (float(rows[i][8]) - 1.0)/(9.0-1.0)
-        ratings[rows[i][1]] = {"Valence": valence, "Arousal": arousal, "Dominance": dominance}
-
-    # NRC Emotion Lexicon (2014)
-    with open(DATA_ROOT / 'lexicons/NRC-emotion-lexicon-wordlevel-v0.92.txt', 'r') as f:
-        f.readline()
-        for line in f:
-            splitted = line.strip().split('\t')
-            if splitted[0] not in nrc_emotion:
-                nrc_emotion[splitted[0]] = {
-                    'anger': float(splitted[1]),
-                    'disgust': float(splitted[3]),
-                    'fear': float(splitted[4]),
-                    'joy': float(splitted[5]),
-                    'sadness': float(splitted[8]),
-                    'surprise': float(splitted[9])
-                }
-
-    # NRC Affect Intensity (2018)
-    with open(DATA_ROOT / 'lexicons/nrc_affect_intensity.txt', 'r') as f:
-        f.readline()
-        for line in f:
-            splitted = line.strip().split('\t')
-            if splitted[0] not in nrc_affect_intensity:
-                nrc_affect_intensity[splitted[0]] = {
-                    'anger': float(splitted[1]),
-                    'disgust': float(splitted[3]),
-                    'fear': float(splitted[4]),
-                    'joy': float(splitted[5]),
-                    'sadness': float(splitted[8]),
-                    'surprise': float(splitted[9])
-                }
-
-    # NRC Hashtag Emotion Lexicon (2015)
-    with open(DATA_ROOT / 'lexicons/NRC-Hashtag-Emotion-Lexicon-v0.2.txt', 'r') as f:
-        f.readline()
-        for line in f:
-            splitted = line.strip().split('\t')
-            splitted[0] = splitted[0].replace('#', '')
-            if splitted[0] not in nrc_hashtag_emotion:
-                nrc_hashtag_emotion[splitted[0]] = {
-                    'anger': float(splitted[1]),
-                    'disgust': float(splitted[3]),
-                    'fear': float(splitted[4]),
-                    'joy': float(splitted[5]),
-                    'sadness': float(splitted[8]),
-                    'surprise': float(splitted[9])
-                }
-
-    # BingLiu (2004) and MPQA (2005)
-    with open(DATA_ROOT / 'lexicons/BingLiu.txt', 'r') as f:
-        for line in f:
-            splitted = line.strip().split('\t')
-            if splitted[0] not in bingliu_mpqa:
-                bingliu_mpqa[splitted[0]] = splitted[1]
-    with open(DATA_ROOT / 'lexicons/mpqa.txt', 'r') as f:
-        for line in f:
-            splitted = line.strip().split('\t')
-            if splitted[0] not in bingliu_mpqa:
-                bingliu_mpqa[splitted[0]] = splitted[1]
-
-    with open(DATA_ROOT / 'lexicons/AFINN-en-165.txt', 'r') as f:
-        for line in f:
-            splitted = line.strip().split('\t')
-            if splitted[0] not in afinn:
-                score = float(splitted[1])
-                normalized_score = (score - (-5)) / (5-(-5))
-                afinn[splitted[0]] = normalized_score
-
-    with open(DATA_ROOT / 'lexicons/stopwords.txt', 'r') as f:
-        for line in f:
-            stopwords.append(line.strip())
-
-    with open(DATA_ROOT / 'lexicons/slangs.txt', 'r') as f:
-        for line in f:
-            splitted = line.strip().split(',', 1)
-            slangs[splitted[0]] = splitted[1]
-
-    with open(DATA_ROOT / 'lexicons/negated_words.txt', 'r') as f:
-        for line in f:
-            splitted = line.strip().split(',', 1)
-            negated[splitted[0]] = splitted[1]
-
-    with open(DATA_ROOT / 'lexicons/emoticons.txt', 'r') as f:
-        for line in f:
-            emoticons.append(line.strip())
-
-
-load_emotion_lexicons()
-
-
-# Load hedge lexicons
-logger.info('Loading hedge lexicons...')
+def load_emotion_model():
+    """
+    Loads the pre-trained model into this process unless already loaded, and returns (model, graph).
 
-lmtzr = WordNetLemmatizer()
-hedge_words = []
-discourse_markers = []
+    TensorFlow sessions and the thread pools they start do not survive fork(), so a process which forks workers must
+    not load the model itself: each worker loads its own copy after forking. Only the lexicons are shared copy-on-write.
+    """
+    global model, graph
+    if model is None:
+        logger.info('Loading pre-trained emotion recognition model...')
+        # https://github.com/keras-team/keras/issues/2397#issuecomment-306687500
+        model = load_model(str(DATA_ROOT / 'models/model.h5'))
+        model._make_predict_function()
+        graph = tf.get_default_graph()
+    return model, graph
 
 
-def load_hedge_lexicons():
-    with open(DATA_ROOT / "resources/hedge_words.txt", "r") as f:
-        for line in f:
-            if '#' in line:
-                continue
-            elif line.strip() != "":
-                hedge_words.append(line.strip())
+with open(DATA_ROOT / 'models/variables-slim.p', 'rb') as f:
+    lb, tokenizer_tweets, max_tweet_length, tokenizer_hash_emo, max_hash_emo_length = pickle.load(f)
 
-    with open(DATA_ROOT / "resources/discourse_markers.txt", "r") as f:
-        for line in f:
-            if '#' in line:
-                continue
-            elif line.strip() != "":
-                discourse_markers.append(line.strip())
 
+# Lexicons
+logger.info('Loading emotion and hedge lexicons...')
+
+lexicons = load_lexicons(str(DATA_ROOT))
+boosters = lexicons['boosters']
+cues = lexicons['cues']
+bingliu_mpqa = lexicons['bingliu_mpqa']
+nrc_emotion = lexicons['nrc_emotion']
+nrc_affect_intensity = lexicons['nrc_affect_intensity']
+nrc_hashtag_emotion = lexicons['nrc_hashtag_emotion']
+afinn = lexicons['afinn']
+ratings = lexicons['ratings']
+stopwords = lexicons['stopwords']
+slangs = lexicons['slangs']
+negated = lexicons['negated']
+emoticons = lexicons['emoticons']
+hedge_words = lexicons['hedge_words']
+discourse_markers = lexicons['discourse_markers']
+feature_table = FeatureTable(ratings, nrc_emotion, nrc_affect_intensity, afinn, bingliu_mpqa, nrc_hashtag_emotion)
+vader = SentimentIntensityAnalyzer()
 
-load_hedge_lexicons()
+lmtzr = WordNetLemmatizer()
 
 
 # Load NLP server Python interface
@@ -213,18 +105,78 @@ logger.info('Loading StanfordCoreNLP Python interface...')
 
 class MyStanfordCoreNLP(StanfordCoreNLP):
     """
-    Customize dependency_parse method.
+    Customize dependency_parse method, and send requests over a pooled keep-alive session which can be used from
+    CORENLP_CONCURRENCY threads at once.
     """
+    @property
+    def session(self):
+        # Sockets must not be shared with forked workers
+        if getattr(self, '_session_pid', None) != os.getpid():
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=global_config.CORENLP_CONCURRENCY)
+            self._session = requests.Session()
+            self._session.mount('http://', adapter)
+            self._session.mount('https://', adapter)
+            self._session_pid = os.getpid()
+        return self._session
+
+    def _request(self, annotators=None, data=None, *args, **kwargs):
+        properties = {'annotators': annotators, 'outputFormat': 'json'}
+        properties.update(kwargs.get('properties') or {})
+        params = {'properties': str(properties), 'pipelineLanguage': self.lang}
+        if 'pattern' in kwargs:
+            params['pattern'] = kwargs['pattern']
+        metrics.count('corenlp_requests')
+        with metrics.timer('corenlp_request'):
+            r = self.session.post(
+                self.url, params=params, data=data.encode('utf-8'), timeout=global_config.CORENLP_TIMEOUT)
+            r.raise_for_status()
+            return r.json()
+
     def dependency_parse(self, text):
-        # DEV: the arguments of following line will be changed after stanfordcorenlp-3.9.1.1
         r_dict = self._request('depparse', text)
-        ls = []
-        for s in r_dict['sentences']:
-            tmp = []
-            for dep in s['basicDependencies']:
-                tmp.append((dep['dep'], dep['governorGloss'], dep['dependentGloss']))
-            ls.append(tmp)
+        return [s['dependencies'] for s in _read_sentences(r_dict)]
+
+    def parse(self, text):
+        """
+        Request dependency parse and POS tags in one round-trip. Returns a list of sentences:
+
+          [{'dependencies': [(dep, governor, dependent), ...], 'tokens': [(word, tag), ...]}, ...]
+        """
+        r_dict = self._request('depparse,pos', text)
+        return _read_sentences(r_dict)
+
+    def parse_many(self, texts):
+        """
+        Annotates many texts in one request. Returns a list holding the parse() result of each text.
+
+        The texts are joined by blank lines, which CoreNLP always treats as sentence breaks, and the returned sentences
+        are mapped back to their text by character offset. Texts must not contain line breaks themselves.
+        """
+        starts = []
+        offset = 0
+        for text in texts:
+            starts.append(offset)
+            # CoreNLP counts offsets in UTF-16 code units
+            offset += len(text.encode('utf-16-le')) // 2 + 2
+
+        r_dict = self._request(
+            'depparse,pos', '\n\n'.join(texts), properties={'ssplit.newlineIsSentenceBreak': 'two'})
+        ls = [[] for _ in texts]
+        for s, sentence in zip(r_dict['sentences'], _read_sentences(r_dict)):
+            ls[bisect_right(starts, s['tokens'][0]['characterOffsetBegin']) - 1].append(sentence)
         return ls
 
 
-nlp = MyStanfordCoreNLP('http://stanford_corenlp', port=9999)
+def _read_sentences(r_dict):
+    ls = []
+    for s in r_dict['sentences']:
+        ls.append({
+            'dependencies': [
+                (dep['dep'], dep['governorGloss'], dep['dependentGloss']) for dep in s.get('basicDependencies', [])
+            ],
+            'tokens': [(token['word'], token['pos']) for token in s['tokens']],
+        })
+    return ls
+
+
+nlp = MyStanfordCoreNLP(global_config.CORENLP_URL, port=global_config.CORENLP_PORT)
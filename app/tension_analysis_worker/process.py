@@ -1,89 +1,147 @@
 import csv
+import gzip
+import io
+import json
+import logging
+import os
+import re
+import shutil
+import traceback
 
 from nltk import sent_tokenize
 from nltk.tokenize import word_tokenize
 import numpy as np
 
 import global_config
+import metrics
+from storage import RESULT_INDEX_RECORD, open_user_file
 
 from .preload import (
-    boosters, cues, graph, lb, max_hash_emo_length, max_tweet_length, model,
-    tokenizer_hash_emo, tokenizer_tweets
+    DATA_ROOT, boosters, cues, lb, load_emotion_model, max_hash_emo_length, max_tweet_length, tokenizer_hash_emo,
+    tokenizer_tweets
+)
+from .utils.cache import DiskCache, LRUCache, TieredCache, file_fingerprint
+from .utils.emotion_helpers import clean_texts, encode_text, feature_generation, vader_word_scores
+from .utils.hedge_detection import (
+    annotation_cache, annotation_texts, check_without_annotation, is_hedged_sentence, prefetch_annotations
 )
-from .utils.emotion_helpers import clean_texts, encode_text, feature_generation
-from .utils.hedge_detection import is_hedged_sentence
 
+logger = logging.getLogger(__name__)
 
 # Initializations
 NEGATIVE_EMOTIONS = ["anger", 'fear', "sadness"]
 QUES_TYPES = ["what", "when", "where", "who", "why", "how", "yesno", "mixed"]
+# Finds every occurrence of a question type in one scan. No type is a prefix of another, so the lookahead yields
+# exactly the occurrences that `type in ques` would find.
+QUES_TYPES_REGEX = re.compile('(?=({}))'.format('|'.join(QUES_TYPES)))
 
 
 # Pre-trained model for emotion recognition
 # emotions = ['anger', 'emotion-not-listed', 'fear', 'happiness', 'NE', 'sadness']
 
+# Predicted emotions keyed by cleaned sentence. The model only sees the cleaned tokens and hashtags/emojis.
+emotion_cache = TieredCache(
+    LRUCache(global_config.EMOTION_CACHE_SIZE),
+    DiskCache(
+        global_config.EMOTION_DISK_CACHE_PATH,
+        file_fingerprint(str(DATA_ROOT / 'models/model.h5'), str(DATA_ROOT / 'models/variables-slim.p')),
+        global_config.EMOTION_DISK_CACHE_SIZE
+    ) if global_config.EMOTION_DISK_CACHE_PATH else None
+)
+
 
 # Returns negative if given sentence contains negative emotion, otherwise returns positive
 # Input: Sentence or Text
 # Output: "Negative" or "Positive"
 def get_emotion(sentence):
-    cleaned_sentences, hash_emos = clean_texts([sentence])
-    features = feature_generation(cleaned_sentences, hash_emos)
-
-    evalX = encode_text(tokenizer_tweets, cleaned_sentences, max_tweet_length)
-    encoded_hash_emo = encode_text(tokenizer_hash_emo, hash_emos, max_hash_emo_length)
-
-    with graph.as_default():
-        predictedY = model.predict([evalX, encoded_hash_emo, features])
-    predicted_classes = lb.inverse_transform(predictedY)
-    if predicted_classes[0] in NEGATIVE_EMOTIONS:
-        return "negative"
-    else:
-        return "positive"
+    return get_emotions([sentence])[0]
+
+
+# Batched version of get_emotion: cleans, encodes and predicts all sentences at once
+# Input: List of sentences
+# Output: List of "negative" or "positive", one per sentence
+def get_emotions(sentences, batch_size=None):
+    if not sentences:
+        return []
+    if batch_size is None:
+        batch_size = global_config.EMOTION_BATCH_SIZE
+
+    metrics.count('emotion_sentences', len(sentences))
+    with metrics.timer('emotion_clean'):
+        cleaned_sentences, hash_emos = clean_texts(sentences)
+        keys = [json.dumps([c, h]) for c, h in zip(cleaned_sentences, hash_emos)]
+    with metrics.timer('emotion_cache'):
+        predicted_classes = emotion_cache.get_many(set(keys))
+
+    # Predict each distinct sentence missing from the cache once
+    missing = {}
+    for i, key in enumerate(keys):
+        if key not in predicted_classes:
+            missing.setdefault(key, i)
+    if missing:
+        metrics.count('emotion_predicted', len(missing))
+        cleaned_missing = [cleaned_sentences[i] for i in missing.values()]
+        hash_emos_missing = [hash_emos[i] for i in missing.values()]
+        with metrics.timer('emotion_features'):
+            features = feature_generation(cleaned_missing, hash_emos_missing)
+
+            evalX = encode_text(tokenizer_tweets, cleaned_missing, max_tweet_length)
+            encoded_hash_emo = encode_text(tokenizer_hash_emo, hash_emos_missing, max_hash_emo_length)
+
+        model, graph = load_emotion_model()
+        with metrics.timer('emotion_predict'), graph.as_default():
+            predictedY = model.predict([evalX, encoded_hash_emo, features], batch_size=batch_size)
+        predicted = dict(zip(missing, (str(c) for c in lb.inverse_transform(predictedY))))
+        with metrics.timer('emotion_cache'):
+            emotion_cache.put_many(predicted)
+        predicted_classes.update(predicted)
+
+    return ["negative" if predicted_classes[key] in NEGATIVE_EMOTIONS else "positive" for key in keys]
+
+
+# Returns the question type of every pair and the number of words of every answer, tokenizing each answer once
+# Input: question-answer pairs
+# Output: NumPy array of question types (keys of the ques_statistics() dictionary), NumPy array of word counts
+def prepare_pairs(pairs):
+    types = []
+    for pair in pairs:
+        found_types = set(QUES_TYPES_REGEX.findall(pair[0].lower()))
+        if len(found_types) == 0:
+            types.append("yesno")
+        elif len(found_types) == 1:
+            types.append(found_types.pop())
+        else:
+            types.append("mixed")
+    number_of_words = [len(word_tokenize(pair[1].lower())) for pair in pairs]
+    return np.array(types, dtype=object), np.array(number_of_words, dtype=np.int64)
 
 
 # Returns statistics (mean, standard deviation) for all kind of question types in a transcript
-# Input: question-answer pairs
+# Input: question-answer pairs, or their prepare_pairs() output
 # Output: Dictionary with mean and standard deviation
-def ques_statistics(pairs):
-    d = {"what": [], "when": [], "where": [], "who": [], "why": [], "how": [], "yesno": [], "mixed": []}
-    stats = {"what": {"mean": 0.0, "std": 0.0},
-             "when": {"mean": 0.0, "std": 0.0},
-             "where": {"mean": 0.0, "std": 0.0},
-             "who": {"mean": 0.0, "std": 0.0},
-             "why": {"mean": 0.0, "std": 0.0},
-             "how": {"mean": 0.0, "std": 0.0},
-             "yesno": {"mean": 0.0, "std": 0.0},
-             "mixed": {"mean": 0.0, "std": 0.0}}
-
-    for pair in pairs:
-        ques = pair[0].lower()
-        ans = pair[1].lower()
-        counter = 0
-        found_type = ""
-        for type in QUES_TYPES:
-            if type in ques:
-                counter += 1
-                found_type = type
-
-        if counter == 0:
-            d["yesno"].append(len(word_tokenize(ans)))
-        elif counter == 1:
-            d[found_type].append(len(word_tokenize(ans)))
-        else:
-            d["mixed"].append(len(word_tokenize(ans)))
+def ques_statistics(pairs, types=None, number_of_words=None):
+    if types is None or number_of_words is None:
+        types, number_of_words = prepare_pairs(pairs)
 
-    for key, value in d.items():
+    stats = {}
+    for type in QUES_TYPES:
+        value = number_of_words[types == type]
         if len(value) > 0:
-            stats[key]["mean"] = np.mean(value)
-            stats[key]["std"] = np.std(value)
+            stats[type] = {"mean": np.mean(value), "std": np.std(value)}
         else:
-            stats[key]["mean"] = 0.0
-            stats[key]["std"] = 0.0
-
+            stats[type] = {"mean": 0.0, "std": 0.0}
     return stats
 
 
+# Returns whether each answer is more than three standard deviations away from the mean length of its question type
+# Input: prepare_pairs() output, ques_statistics() output
+# Output: NumPy array of booleans
+def length_outliers(types, number_of_words, stats):
+    mean = np.array([stats[type]["mean"] for type in types], dtype=np.float64)
+    std = np.array([stats[type]["std"] for type in types], dtype=np.float64)
+    return (number_of_words > mean + 3 * std) | (number_of_words < mean - 3 * std)
+
+
 # Returns True if sentence contains boosting, otherwise returns False
 # Input: Sentence
 # Output: True/False
@@ -101,71 +159,153 @@ def is_boosting(s):
                 return True
 
 
+class ChunkedWriter(object):
+    """
+    CSV writer which appends rows to the output file in whole, fsync-ed chunks, so that the partial result can be read
+    while the analysis is running. Given an `index_fileobj`, it appends the storage.RESULT_INDEX_RECORD of each row
+    there once the row is on disk.
+    """
+    def __init__(self, output_fileobj, index_fileobj=None):
+        self.output_fileobj = output_fileobj
+        self.index_fileobj = index_fileobj
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(
+            self.buffer,
+            delimiter=global_config.CSV_DELIMITER,
+            quotechar=global_config.CSV_QUOTECHAR,
+            quoting=csv.QUOTE_MINIMAL
+        )
+        self.encoding = getattr(output_fileobj, 'encoding', None) or 'utf-8'
+        self.offset = 0
+        self.tension_rows = 0
+        self.records = []
+
+    def writerow(self, row):
+        start = self.buffer.tell()
+        self.writer.writerow(row)
+        if self.index_fileobj is not None:
+            self.buffer.seek(start)
+            self.offset += len(self.buffer.read().encode(self.encoding))
+            if row[2] == "Tension":
+                self.tension_rows += 1
+            self.records.append(RESULT_INDEX_RECORD.pack(self.offset, self.tension_rows))
+
+    @metrics.timed('result_write')
+    def flush(self):
+        self.output_fileobj.write(self.buffer.getvalue())
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        self.output_fileobj.flush()
+        try:
+            os.fsync(self.output_fileobj.fileno())
+        except (AttributeError, io.UnsupportedOperation):
+            pass  # Not a real file
+
+        # Only index rows which readers can find in the output file
+        if self.records:
+            self.index_fileobj.write(b''.join(self.records))
+            self.index_fileobj.flush()
+            self.records = []
+
+
+# Writes the gzip-compressed copy of the result of `user_id`, which nginx serves to clients accepting gzip
+def compress_result(user_id):
+    try:
+        with open_user_file(user_id, 'result', mode='rb') as f, \
+                open_user_file(user_id, 'result_gzip', mode='wb') as f_gzip:
+            with gzip.GzipFile(fileobj=f_gzip, mode='wb') as gz:
+                shutil.copyfileobj(f, gz)
+    except Exception:
+        # Clients are sent the uncompressed result instead
+        logger.warning(traceback.format_exc())
+
+
+# Hits and misses of the caches of the worker, as metrics counters
+def cache_counters():
+    caches = [('annotation_cache', annotation_cache.info()), ('emotion_cache', emotion_cache.memory.info())]
+    if emotion_cache.disk is not None:
+        caches.append(('emotion_disk_cache', emotion_cache.disk.info()))
+    vader = vader_word_scores.cache_info()
+    caches.append(('vader_cache', {'hits': vader.hits, 'misses': vader.misses}))
+
+    counters = {}
+    for name, info in caches:
+        counters[name + '_hits'] = info['hits']
+        counters[name + '_misses'] = info['misses']
+    return counters
+
+
 # Generates a csv file containing identified tension points for the provided interview file
 # Input: List of question-answer pairs (Ex: [(q1,a1),(q2,a2),...])
-def tension_analysis(ques_ans, output_fileobj, update_percentage):
-    update_percentage(1)
-    writer = csv.writer(
-        output_fileobj,
-        delimiter=global_config.CSV_DELIMITER,
-        quotechar=global_config.CSV_QUOTECHAR,
-        quoting=csv.QUOTE_MINIMAL
-    )
+# Reports to `progress`, a ProgressReporter, and writes the row index to `index_fileobj` if given
+def tension_analysis(ques_ans, output_fileobj, progress, index_fileobj=None):
+    caches_before = cache_counters()
+    progress.update(percentage=1, stage='emotion', pairs_total=len(ques_ans))
+    writer = ChunkedWriter(output_fileobj, index_fileobj)
     writer.writerow(['Content', 'Role', 'Predicted Label'])
+    writer.flush()
 
-    stats = ques_statistics(ques_ans)
+    with metrics.timer('question_statistics'):
+        types, number_of_words = prepare_pairs(ques_ans)
+        outliers = length_outliers(types, number_of_words, ques_statistics(ques_ans, types, number_of_words))
     total = len(ques_ans)
-    for i, pair in enumerate(ques_ans, 1):
-        ques = pair[0].lower()
+
+    # Only the first five sentences of every answer are classified. Predict them all in one go.
+    with metrics.timer('sentence_split'):
+        sentences_per_pair = [sent_tokenize(pair[1].lower()) for pair in ques_ans]
+    with metrics.timer('emotion'):
+        emotions = iter(get_emotions([s for sentences in sentences_per_pair for s in sentences[:5]]))
+    progress.update(stage='analysis')
+    sentences_done = 0
+
+    window = global_config.CORENLP_PREFETCH_WINDOW
+    for i, (pair, sentences) in enumerate(zip(ques_ans, sentences_per_pair), 1):
+        if (i - 1) % window == 0:
+            # Apply the cheap hedge rules to the sentences of the next pairs once, then annotate the sentences they
+            # leave undecided concurrently, ahead of the remaining rules
+            with metrics.timer('hedge'):
+                checked_window = [
+                    [check_without_annotation(s) for s in upcoming[:5]]
+                    for upcoming in sentences_per_pair[i - 1:i - 1 + window]
+                ]
+            with metrics.timer('corenlp_prefetch'):
+                prefetch_annotations([
+                    text for checked_pair in checked_window for checked in checked_pair
+                    for text in annotation_texts(checked)
+                ])
+        checked_pair = checked_window[(i - 1) % window]
+
         ans = pair[1].lower()
-        sentences = sent_tokenize(ans)
         writer.writerow([pair[0], 'Interviewer', "-"])
         isNegativeEmotion = False
         isHedging = False
         isQuestion = False
-        isOutlier = False
         isBoosting = False
         cuePresent = False
 
-        for s in sentences[:5]:
-            if get_emotion(s) == "negative":
+        for s, checked in zip(sentences[:5], checked_pair):
+            if next(emotions) == "negative":
                 isNegativeEmotion = True
 
-            if is_hedged_sentence(s):
-                isHedging = True
+            with metrics.timer('hedge'):
+                if is_hedged_sentence(s, checked):
+                    isHedging = True
 
-            if is_boosting(s):
-                isBoosting = True
+            with metrics.timer('boosting'):
+                if is_boosting(s):
+                    isBoosting = True
+        sentences_done += len(sentences[:5])
 
-        for cue in cues:
-            if cue in ans:
-                cuePresent = True
+        with metrics.timer('cues'):
+            for cue in cues:
+                if cue in ans:
+                    cuePresent = True
 
         for qt in ["what", "when", "where", "who", "why", "how"]:
             if len(sentences) > 0 and qt in sentences[0] and "?" in sentences[0]:
                 isQuestion = True
 
-        number_of_words = len(word_tokenize(ans))
-        counter = 0
-        found_type = ""
-
-        for type in QUES_TYPES:
-            if type in ques:
-                counter += 1
-                found_type = type
-
-        if counter == 0:
-            mean = stats["yesno"]["mean"]
-            std = stats["yesno"]["std"]
-        elif counter == 1:
-            mean = stats[found_type]["mean"]
-            std = stats[found_type]["std"]
-        else:
-            mean = stats["mixed"]["mean"]
-            std = stats["mixed"]["std"]
-
-        if number_of_words > mean + 3 * std or number_of_words < mean - 3 * std:
-            isOutlier = True
+        isOutlier = bool(outliers[i - 1])
 
         if (isNegativeEmotion and isHedging) or \
            (isBoosting and isHedging) or \
@@ -175,4 +315,11 @@ def tension_analysis(ques_ans, output_fileobj, update_percentage):
             writer.writerow([pair[1], 'Interviewee', "Tension"])
         else:
             writer.writerow([pair[1], 'Interviewee', "No Tension"])
-        update_percentage(int(1 + float(i) / total * 99.0))
+        if i % global_config.RESULT_CHUNK_SIZE == 0 or i == total:
+            writer.flush()
+        progress.update(percentage=int(1 + float(i) / total * 99.0), pairs_done=i, sentences_done=sentences_done)
+
+    metrics.count('pairs', total)
+    metrics.count('sentences', sentences_done)
+    for name, value in cache_counters().items():
+        metrics.count(name, value - caches_before[name])
@@ -0,0 +1,128 @@
+import collections
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+import global_config
+import metrics
+from storage import open_user_file, remove_user_file
+
+
+logger = logging.getLogger(__name__)
+
+
+def _setting(name):
+    """
+    Returns the PROFILE_* setting from the TENSION_ANALYSIS_<name> environment variable if set, else from
+    global_config. Empty or 'none' means None. A value which is not a number is ignored with a warning.
+    """
+    value = os.environ.get('TENSION_ANALYSIS_' + name)
+    if value is None:
+        return getattr(global_config, name)
+    if value.strip().lower() in ('', 'none'):
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        logger.warning('Ignoring TENSION_ANALYSIS_{}={!r}, which is not a number. Using {!r} from global_config.'
+                       .format(name, value, getattr(global_config, name)))
+        return getattr(global_config, name)
+
+
+# Read once when the worker starts
+PROFILE_SAMPLE_RATE = _setting('PROFILE_SAMPLE_RATE')
+PROFILE_SLOW_JOB_SECONDS = _setting('PROFILE_SLOW_JOB_SECONDS')
+
+
+class SamplingProfiler(object):
+    """
+    Samples the stack of one thread every `interval` seconds from a background thread, counting identical stacks. The
+    counts are written in the collapsed stack format read by flamegraph.pl and speedscope:
+
+      package.module:function;package.module:function 12
+    """
+    def __init__(self, thread_id=None, interval=0.01):
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                break  # The thread has ended
+            self.stacks[self._stack(frame)] += 1
+            self.samples += 1
+            del frame
+
+    @staticmethod
+    def _stack(frame):
+        names = []
+        while frame is not None:
+            module = frame.f_globals.get('__name__') or os.path.basename(frame.f_code.co_filename)
+            names.append('{}:{}'.format(module, frame.f_code.co_name))
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+    def write_folded(self, f):
+        for stack, count in self.stacks.most_common():
+            f.write('{} {}\n'.format(stack, count))
+
+
+class JobProfiler(object):
+    """
+    Profiles the job run inside the block when it is one of the PROFILE_SAMPLE_RATE jobs picked at random, or when
+    PROFILE_SLOW_JOB_SECONDS is set, in case the job turns out that slow. save() keeps the profile of those jobs only.
+    """
+    def __init__(self):
+        rate = PROFILE_SAMPLE_RATE or 0
+        self.threshold = PROFILE_SLOW_JOB_SECONDS
+        self.sampled = random.random() < rate
+        self.profiler = None
+        if self.sampled or self.threshold is not None:
+            self.profiler = SamplingProfiler(interval=global_config.PROFILE_INTERVAL)
+        self.seconds = None
+
+    def __enter__(self):
+        self.started_at = time.time()
+        if self.profiler is not None:
+            self.profiler.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if self.profiler is not None:
+            self.profiler.stop()
+        self.seconds = time.time() - self.started_at
+
+    def save(self, user_id):
+        """
+        Writes the profile of the job next to its results if it was sampled or slow, or removes any earlier one.
+        """
+        slow = self.threshold is not None and self.seconds >= self.threshold
+        if self.profiler is None or not (self.sampled or slow):
+            remove_user_file(user_id, 'profile')
+            return
+        try:
+            with open_user_file(user_id, 'profile', mode='w') as f:
+                self.profiler.write_folded(f)
+        except Exception as e:
+            logger.warning('Cannot save the profile of job {}: {}'.format(user_id, e))
+            return
+        metrics.count('jobs_profiled')
+        logger.info('Job {} took {:.1f}s{}. Saved a profile of {} samples.'.format(
+            user_id, self.seconds, ' (slow)' if slow else '', self.profiler.samples))
@@ -0,0 +1,72 @@
+import time
+
+import global_config
+from storage import write_progress
+
+
+class ProgressReporter(object):
+    """
+    Reports the progress of a job through storage.write_progress. A new state is only written when it differs from the
+    last written one, and then only if the stage changed, the percentage moved by PROGRESS_MIN_STEP or more, or
+    PROGRESS_MIN_INTERVAL seconds have passed.
+    """
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.state = {
+            'percentage': 0,
+            'stage': 'scheduled',
+            'pairs_done': 0,
+            'pairs_total': 0,
+            'sentences_done': 0,
+            'eta': None,
+        }
+        self.stage_started_at = time.time()
+        self.written_state = None
+        self.written_at = 0
+
+    def update(self, **fields):
+        if 'stage' in fields and fields['stage'] != self.state['stage']:
+            self.stage_started_at = time.time()
+        self.state.update(fields)
+
+        # Remaining seconds, extrapolated from the pairs done so far in the current stage
+        done, total = self.state['pairs_done'], self.state['pairs_total']
+        if 0 < done < total:
+            elapsed = time.time() - self.stage_started_at
+            self.state['eta'] = int(elapsed / done * (total - done))
+        else:
+            self.state['eta'] = None
+
+        if self._should_write():
+            self.flush()
+
+    def done(self):
+        self.state.update(percentage=100, stage='done', pairs_done=self.state['pairs_total'], eta=None)
+        self.flush()
+
+    def flush(self):
+        write_progress(self.user_id, self.state)
+        self.written_state = dict(self.state)
+        self.written_at = time.time()
+
+    def _should_write(self):
+        last = self.written_state
+        if last is None or last['stage'] != self.state['stage']:
+            return True
+        if all(last[k] == v for k, v in self.state.items() if k != 'eta'):
+            return False
+        return (
+            abs(self.state['percentage'] - last['percentage']) >= global_config.PROGRESS_MIN_STEP or
+            time.time() - self.written_at >= global_config.PROGRESS_MIN_INTERVAL
+        )
+
+
+class ProgressRecorder(object):
+    """
+    Keeps what tension_analysis reports instead of writing it to storage, for runs outside the queue.
+    """
+    def __init__(self):
+        self.state = {}
+
+    def update(self, **fields):
+        self.state.update(fields)
@@ -0,0 +1,168 @@
+from collections import OrderedDict
+import logging
+import os
+import sqlite3
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache(object):
+    """
+    In-memory cache holding at most `maxsize` entries, evicting the least recently used ones.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get_many(self, keys):
+        found = {}
+        for key in keys:
+            try:
+                self.data.move_to_end(key)
+            except KeyError:
+                self.misses += 1
+            else:
+                self.hits += 1
+                found[key] = self.data[key]
+        return found
+
+    def put_many(self, items):
+        for key, value in items.items():
+            self.data[key] = value
+            self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def clear(self):
+        """
+        Removes all entries and resets the hit and miss counts.
+        """
+        self.data.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.data), 'maxsize': self.maxsize}
+
+
+class DiskCache(object):
+    """
+    SQLite cache which can be shared by all workers of a host. Entries belong to a `namespace` so that a new model does
+    not read answers of the old one. Holds about `maxsize` entries, evicting the least recently used ones.
+    """
+    EVICTION_CHECK_INTERVAL = 1000  # puts
+
+    def __init__(self, path, namespace, maxsize):
+        self.path = path
+        self.namespace = namespace
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.puts_since_eviction_check = 0
+
+    def _connect(self):
+        # Connections are not shared across forked workers; open one per operation.
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS cache '
+            '(namespace TEXT, key TEXT, value TEXT, accessed_at REAL, PRIMARY KEY (namespace, key))')
+        conn.execute('CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)')
+        return conn
+
+    def get_many(self, keys):
+        keys = list(keys)
+        found = {}
+        conn = self._connect()
+        try:
+            # Stay well below SQLITE_MAX_VARIABLE_NUMBER
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                placeholders = ','.join('?' * len(chunk))
+                rows = conn.execute(
+                    'SELECT key, value FROM cache WHERE namespace = ? AND key IN ({})'.format(placeholders),
+                    [self.namespace] + chunk).fetchall()
+                found.update(rows)
+            if found:
+                conn.executemany(
+                    'UPDATE cache SET accessed_at = ? WHERE namespace = ? AND key = ?',
+                    [(time.time(), self.namespace, key) for key in found])
+        finally:
+            conn.close()
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, items):
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.executemany(
+                'INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)',
+                [(self.namespace, key, value, now) for key, value in items.items()])
+            self.puts_since_eviction_check += len(items)
+            if self.puts_since_eviction_check >= self.EVICTION_CHECK_INTERVAL:
+                self.puts_since_eviction_check = 0
+                size, = conn.execute('SELECT COUNT(*) FROM cache').fetchone()
+                if size > self.maxsize:
+                    conn.execute(
+                        'DELETE FROM cache WHERE rowid IN (SELECT rowid FROM cache ORDER BY accessed_at LIMIT ?)',
+                        (size - self.maxsize,))
+        finally:
+            conn.close()
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'maxsize': self.maxsize}
+
+
+class TieredCache(object):
+    """
+    Memory cache in front of an optional disk cache. Entries found on disk are copied to memory.
+    """
+    def __init__(self, memory, disk=None):
+        self.memory = memory
+        self.disk = disk
+
+    def get_many(self, keys):
+        found = self.memory.get_many(keys)
+        missing = [key for key in keys if key not in found]
+        if self.disk is not None and missing:
+            try:
+                from_disk = self.disk.get_many(missing)
+            except sqlite3.Error as e:
+                logger.warning('Disk cache unavailable: {}'.format(e))
+            else:
+                self.memory.put_many(from_disk)
+                found.update(from_disk)
+        return found
+
+    def put_many(self, items):
+        self.memory.put_many(items)
+        if self.disk is not None and items:
+            try:
+                self.disk.put_many(items)
+            except sqlite3.Error as e:
+                logger.warning('Disk cache unavailable: {}'.format(e))
+
+    def info(self):
+        info = {'memory': self.memory.info()}
+        if self.disk is not None:
+            info['disk'] = self.disk.info()
+        return info
+
+
+def file_fingerprint(*paths):
+    """
+    Identifies the current version of files by their size and modification time.
+    """
+    parts = []
+    for path in paths:
+        stat = os.stat(path)
+        parts.append('{}:{}:{}'.format(os.path.basename(path), stat.st_size, stat.st_mtime_ns))
+    return '|'.join(parts)
@@ -1,3 +1,4 @@
+from functools import lru_cache
 import re
 
 import emoji
@@ -6,160 +7,119 @@ from keras.preprocessing.sequence import pad_sequences
 from keras.preprocessing.text import Tokenizer
 from nltk.tokenize import TweetTokenizer
 import numpy as np
-from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
 
-
-from ..preload import (
-    afinn, bingliu_mpqa, emoticons, negated, nrc_affect_intensity, nrc_emotion, nrc_hashtag_emotion,
-    ratings, slangs, stopwords
-)
-
-
-def clean_texts(texts):
-    cleaned_tweets = []
-    hash_emos = []
-
-    for text in texts:
-        hash_emo = []
-        text = re.sub('(!){2,}', ' <!repeat> ', text)
-        text = re.sub('(\?){2,}', ' <?repeat> ', text)
-
-        # Tokenize using tweet tokenizer
-        tokenizer = TweetTokenizer(strip_handles=False, reduce_len=True)
-        tokens = tokenizer.tokenize(text.lower())
-
-        # Emojis and emoticons
-        if text_has_emoji(text):
-            temp = []
-            for word in tokens:
-                if char_is_emoji(word):
-                    hash_emo.append(UNICODE_EMOJI[word])
-                elif word in emoticons:
-                    hash_emo.append(word)
-                else:
-                    temp.append(word)
-            tokens = temp
-
-        # Hashtags
-        temp = []
-        for word in tokens:
+import global_config
+
+from ..lexicons import sum_rows
+from ..preload import emoticons, feature_table, negated, slangs, stopwords, vader
+
+
+class TextNormalizer(object):
+    """
+    The cleaning rules of clean_texts, compiled once: emojis, emoticons and hashtags are moved out of the tokens, slangs
+    and negations are expanded, user names, numbers and urls replaced, and stop words and 1-character tokens dropped.
+    All rules but tokenization are applied in one pass over the tokens.
+    """
+    RE_REPEATED_EXCLAMATION = re.compile('(!){2,}')
+    RE_REPEATED_QUESTION = re.compile('(\\?){2,}')
+
+    def __init__(self, emoticons, slangs, negated, stopwords):
+        self.tokenizer = TweetTokenizer(strip_handles=False, reduce_len=True)
+        self.emoji_characters = frozenset(e for e in UNICODE_EMOJI if len(e) == 1)
+        # Token -> entry appended to the hashtags and emojis. Emojis win over emoticons.
+        self.emoji_or_emoticon = {e: e for e in emoticons}
+        self.emoji_or_emoticon.update(UNICODE_EMOJI)
+        # Token -> replacement tokens. Slangs win over negations.
+        self.expansions = {word: negated[word].split() for word in negated}
+        self.expansions.update((word, slangs[word].split()) for word in slangs)
+        self.stopwords = frozenset(stopwords)
+
+    def clean(self, text):
+        text = self.RE_REPEATED_EXCLAMATION.sub(' <!repeat> ', text)
+        text = self.RE_REPEATED_QUESTION.sub(' <?repeat> ', text)
+        # Emoticons are only recognized in texts having an emoji
+        has_emoji = not self.emoji_characters.isdisjoint(text)
+
+        tokens = []
+        emojis = []
+        hashtags = []
+        for word in self.tokenizer.tokenize(text.lower()):
+            if has_emoji and word in self.emoji_or_emoticon:
+                emojis.append(self.emoji_or_emoticon[word])
+                continue
             if '#' in word:
-                word = word.replace('#', '')
-                hash_emo.append(word)
-            else:
-                temp.append(word)
-        tokens = temp
+                hashtags.append(word.replace('#', ''))
+                continue
 
-        # Replace slangs and negated words
-        temp = []
-        for word in tokens:
-            if word in slangs:
-                temp += slangs[word].split()
-            elif word in negated:
-                temp += negated[word].split()
-            else:
-                temp.append(word)
-        tokens = temp
+            for word in self.expansions.get(word, (word,)):
+                if '@' in word:
+                    word = '<user>'
+                elif word.isdigit():
+                    word = '<number>'
+                elif 'http' in word:
+                    continue
+                if len(word) > 1 and word not in self.stopwords:
+                    tokens.append(word)
 
-        # Replace user names
-        tokens = ['<user>' if '@' in word else word for word in tokens]
+        return tokens, emojis + hashtags
 
-        # Replace numbers
-        tokens = ['<number>' if word.isdigit() else word for word in tokens]
+    def clean_batch(self, texts):
+        cleaned_tweets = []
+        hash_emos = []
+        for text in texts:
+            tokens, hash_emo = self.clean(text)
+            cleaned_tweets.append(tokens)
+            hash_emos.append(hash_emo)
+        return cleaned_tweets, hash_emos
 
-        # Remove urls
-        tokens = ['' if 'http' in word else word for word in tokens]
 
-        # Lemmatize
-        # tokens = [lemmatizer.lemmatize(word) for word in tokens]
+normalizer = TextNormalizer(emoticons, slangs, negated, stopwords)
 
-        # Remove stop words
-        tokens = [word for word in tokens if word not in stopwords]
 
-        # Remove tokens having length 1
-        tokens = [word for word in tokens if word != '' and len(word) > 1]
+def clean_texts(texts):
+    return normalizer.clean_batch(texts)
 
-        cleaned_tweets.append(tokens)
-        hash_emos.append(hash_emo)
 
-    return cleaned_tweets, hash_emos
+# VADER (pos, neg, neu) scores of a single word. They only depend on the word.
+@lru_cache(maxsize=global_config.VADER_CACHE_SIZE)
+def vader_word_scores(word):
+    polarity_scores = vader.polarity_scores(word)
+    return polarity_scores['pos'], polarity_scores['neg'], polarity_scores['neu']
 
 
 # This function returns a n-dimensional feature vector
 def feature_generation(texts, hashtags):
-    analyzer = SentimentIntensityAnalyzer()
     feature_dimension = 29
-    feature_vectors = []
-
-    for i in range(len(texts)):
-        feats = [0] * feature_dimension
-        for word in texts[i]:
-            # Warriner er al.
-            if word in ratings:
-                feats[0] += ratings[word]['Valence']
-                feats[1] += ratings[word]['Arousal']
-                feats[2] += ratings[word]['Dominance']
-
-            # Vader Sentiment
-            polarity_scores = analyzer.polarity_scores(word)
-            feats[3] += polarity_scores['pos']
-            feats[4] += polarity_scores['neg']
-            feats[5] += polarity_scores['neu']
-
-            # NRC Emotion
-            if word in nrc_emotion:
-                feats[6] += nrc_emotion[word]['anger']
-                feats[7] += nrc_emotion[word]['disgust']
-                feats[8] += nrc_emotion[word]['fear']
-                feats[9] += nrc_emotion[word]['joy']
-                feats[10] += nrc_emotion[word]['sadness']
-                feats[11] += nrc_emotion[word]['surprise']
-
-            # NRC Affect Intensity
-            if word in nrc_affect_intensity:
-                feats[12] += nrc_affect_intensity[word]['anger']
-                feats[13] += nrc_affect_intensity[word]['disgust']
-                feats[14] += nrc_affect_intensity[word]['fear']
-                feats[15] += nrc_affect_intensity[word]['joy']
-                feats[16] += nrc_affect_intensity[word]['sadness']
-                feats[17] += nrc_affect_intensity[word]['surprise']
-
-            # AFINN
-            if word in afinn:
-                feats[18] += float(afinn[word])
-
-            # BingLiu and MPQA
-            if word in bingliu_mpqa:
-                if bingliu_mpqa[word] == 'positive':
-                    feats[19] += 1
-                else:
-                    feats[20] += 1
-
-        count = len(texts[i])
-        if count == 0:
-            count = 1
-        newArray = np.array(feats)/count
-        feats = list(newArray)
-
-        # Presence of consecutive exclamation mark or question mark
-        for word in texts[i]:
+    feature_vectors = np.zeros((len(texts), feature_dimension))
+
+    # Warriner er al., NRC Emotion, NRC Affect Intensity, AFINN, BingLiu and MPQA
+    feature_vectors[:, :feature_table.WORD_FEATURES] = feature_table.word_features(texts)
+
+    # Vader Sentiment, scored once per distinct word of the batch
+    vocabulary = {}
+    for text in texts:
+        for word in text:
+            vocabulary.setdefault(word, len(vocabulary) + 1)
+    vader_matrix = np.zeros((len(vocabulary) + 1, 3))
+    for word, row in vocabulary.items():
+        vader_matrix[row] = vader_word_scores(word)
+    feature_vectors[:, 3:6] = sum_rows(vader_matrix, [[vocabulary[w] for w in text] for text in texts])
+
+    counts = np.array([len(text) or 1 for text in texts], dtype=float)
+    feature_vectors /= counts[:, np.newaxis]
+
+    # Presence of consecutive exclamation mark or question mark
+    for i, text in enumerate(texts):
+        for word in text:
             if word == '<!REPEAT>':
-                feats[21] = 1
+                feature_vectors[i, 21] = 1
             elif word == '<?REPEAT>':
-                feats[22] = 1
-
-        for word in hashtags[i]:
-            # NRC Hashtag Emotion
-            if word in nrc_hashtag_emotion:
-                feats[23] += nrc_hashtag_emotion[word]['anger']
-                feats[24] += nrc_hashtag_emotion[word]['disgust']
-                feats[25] += nrc_hashtag_emotion[word]['fear']
-                feats[26] += nrc_hashtag_emotion[word]['joy']
-                feats[27] += nrc_hashtag_emotion[word]['sadness']
-                feats[28] += nrc_hashtag_emotion[word]['surprise']
-
-        feature_vectors.append(feats)
-    return np.array(feature_vectors)
+                feature_vectors[i, 22] = 1
+
+    # NRC Hashtag Emotion
+    feature_vectors[:, 23:29] = feature_table.hashtag_features(hashtags)
+
+    return feature_vectors
 
 
 def create_tokenizer(lines):
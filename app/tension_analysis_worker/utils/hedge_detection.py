@@ -1,12 +1,116 @@
+from collections import defaultdict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import logging
 import string
 
 from nltk import ngrams
-from nltk.metrics import jaccard_distance
 from nltk.tokenize import word_tokenize
 
 import global_config
+import metrics
 
 from ..preload import discourse_markers, hedge_words, lmtzr, nlp
+from .cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# Hedges whose rule only reads the words of the sentence
+LEXICAL_HEDGES = {"rather"}
+# Hedges whose rule reads the part-of-speech tag of the following word
+TAGGED_HEDGES = {"think"}
+# Hedges whose rule reads the dependency parse of the sentence
+PARSED_HEDGES = {
+    "assume", "appear", "suppose", "tend", "should", "likely",
+    "feel", "suggest", "believe", "consider", "doubt", "guess", "presume", "hope"
+}
+# is_true_hedge_term() returns None for the other hedge words, so they never make a sentence hedged
+HEDGE_RULES = {
+    hedge: kind
+    for kind, hedges in [('lexical', LEXICAL_HEDGES), ('tagged', TAGGED_HEDGES), ('parsed', PARSED_HEDGES)]
+    for hedge in hedges if hedge in hedge_words
+}
+
+
+# ********* CoreNLP annotation, requested once per distinct text ********* #
+annotation_cache = LRUCache(global_config.CORENLP_CACHE_SIZE)
+
+
+def annotate(text):
+    key = ' '.join(text.split())
+    found = annotation_cache.get_many([key])
+    if key in found:
+        return found[key]
+    annotation = nlp.parse(key)
+    annotation_cache.put_many({key: annotation})
+    return annotation
+
+
+def prefetch_annotations(texts, concurrency=None):
+    """
+    Annotates all `texts` missing from the cache, so that the hedge rules later find them cached. Texts are sent in
+    batches of at most CORENLP_BATCH_MAX_TEXTS texts and CORENLP_BATCH_MAX_CHARS characters, with up to `concurrency`
+    requests in flight. Failed requests are only logged: the rule will request the text again.
+    """
+    if concurrency is None:
+        concurrency = global_config.CORENLP_CONCURRENCY
+    keys = set(' '.join(text.split()) for text in texts)
+    missing = [key for key in keys if key not in annotation_cache]
+    metrics.count('corenlp_prefetched_texts', len(missing))
+
+    def store(batch, future):
+        try:
+            annotation_cache.put_many(dict(zip(batch, future.result())))
+        except Exception as e:
+            logger.warning('Cannot annotate {} texts: {}'.format(len(batch), e))
+
+    # Bound the submitted requests so that results are stored as they arrive
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for batch in _batches(missing):
+            if len(pending) >= 2 * concurrency:
+                store(*pending.popleft())
+            pending.append((batch, executor.submit(nlp.parse_many, batch)))
+        while pending:
+            store(*pending.popleft())
+
+
+def _batches(texts):
+    batch = []
+    length = 0
+    for text in texts:
+        if batch and (len(batch) >= global_config.CORENLP_BATCH_MAX_TEXTS or
+                      length + len(text) > global_config.CORENLP_BATCH_MAX_CHARS):
+            yield batch
+            batch = []
+            length = 0
+        batch.append(text)
+        length += len(text) + 2
+    if batch:
+        yield batch
+
+
+# ********* Returns the texts which is_hedged_sentence(sentence, checked) may request annotations for ********* #
+# ********* `checked` is the check_without_annotation(sentence) result ********* #
+def annotation_texts(checked):
+    candidates = checked.candidates
+    if checked.hedged or not (candidates['tagged'] or candidates['parsed']):
+        return []
+    texts = []
+    if candidates['parsed']:
+        texts.append(checked.text)
+    if candidates['tagged']:
+        for i in range(len(checked.tokenized) - 1):
+            if checked.tokenized[i] == "think":
+                texts.append(checked.tokenized[i + 1])
+    return texts
+
+
+def dependency_tree(text):
+    return annotate(text)[0]['dependencies']
+
+
+def pos_tags(text):
+    return [token for sentence in annotate(text) for token in sentence['tokens']]
 
 
 # ********* Disambiguate Hedge Terms ********* #
@@ -15,24 +119,21 @@ def is_true_hedge_term(hedge, text):
     exclude = set(string.punctuation)
 
     if hedge == "assume":
-        parse_trees = nlp.dependency_parse(text)
-        tree = parse_trees[0]
+        tree = dependency_tree(text)
         for pair in tree:
             if pair[0] == "ccomp" and lmtzr.lemmatize(pair[1], 'v') == hedge:
                 return True
         return False
 
     elif hedge == "appear":
-        parse_trees = nlp.dependency_parse(text)
-        tree = parse_trees[0]
+        tree = dependency_tree(text)
         for pair in tree:
             if (pair[0] in ["xcomp", "ccomp"]) and lmtzr.lemmatize(pair[1], 'v') == hedge:
                 return True
         return False
 
     elif hedge == "suppose":
-        parse_trees = nlp.dependency_parse(text)
-        tree = parse_trees[0]
+        tree = dependency_tree(text)
         for pair in tree:
             if pair[0] == "xcomp" and lmtzr.lemmatize(pair[1], 'v') == hedge:
                 token = pair[2]
@@ -42,16 +143,14 @@ def is_true_hedge_term(hedge, text):
         return True
 
     elif hedge == "tend":
-        parse_trees = nlp.dependency_parse(text)
-        tree = parse_trees[0]
+        tree = dependency_tree(text)
         for pair in tree:
             if pair[0] == "xcomp" and lmtzr.lemmatize(pair[1], 'v') == hedge:
                 return True
         return False
 
     elif hedge == "should":
-        parse_trees = nlp.dependency_parse(text)
-        tree = parse_trees[0]
+        tree = dependency_tree(text)
         for pair in tree:
             if pair[0] == "aux" and pair[2] == hedge:
                 token = pair[1]
@@ -61,14 +160,13 @@ def is_true_hedge_term(hedge, text):
         return True
 
     elif hedge == "likely":
-        parse_trees = nlp.dependency_parse(text)
-        tree = parse_trees[0]
+        tree = dependency_tree(text)
         for pair in tree:
             if pair[2] == hedge:
                 token = pair[1]
                 for temp in tree:
                     if temp[2] == token and temp[1] != "ROOT":
-                        tag = nlp.pos_tag(temp[1])
+                        tag = pos_tags(temp[1])
                         if tag[0][1] in ["NN", "NNS", "NNP", "NNPS"]:
                             return False
         return True
@@ -76,6 +174,8 @@ def is_true_hedge_term(hedge, text):
     elif hedge == "rather":
         s = ''.join(ch for ch in text if ch not in exclude)
         list_of_words = s.split()
+        if hedge not in list_of_words[:-1]:
+            return True
         next_word = list_of_words[list_of_words.index(hedge) + 1]
         if next_word == 'than':
             return False
@@ -86,15 +186,14 @@ def is_true_hedge_term(hedge, text):
         words = word_tokenize(text)
         for i in range(len(words) - 1):
             if words[i] == hedge:
-                tag = nlp.pos_tag(words[i + 1])
+                tag = pos_tags(words[i + 1])
                 if tag[0][1] == "IN":
                     return False
                     break
         return True
 
     elif hedge in ["feel", "suggest", "believe", "consider", "doubt", "guess", "presume", "hope"]:
-        parse_trees = nlp.dependency_parse(text)
-        tree = parse_trees[0]
+        tree = dependency_tree(text)
         isRoot = False
         hasNSubj = False
         for pair in tree:
@@ -106,7 +205,7 @@ def is_true_hedge_term(hedge, text):
                 hasNSubj = True
 
         if isRoot and hasNSubj:
-            tags = nlp.pos_tag(text)
+            tags = pos_tags(text)
             status1 = False
             status2 = False
             for tag in tags:
@@ -120,9 +219,41 @@ def is_true_hedge_term(hedge, text):
                 return False
 
 
-# ********* Determines if a sentence is hedged sentence or not ********* #
-# ********* Returns true if sentence is hedged sentence, otherwise, returns false ********* #
-def is_hedged_sentence(text):
+# ********* Inverted index from tokens to discourse markers ********* #
+# ********* Scores only the markers sharing a token with an n-gram, which are the only ones that can reach a
+# ********* positive Jaccard similarity threshold ********* #
+class DiscourseMarkerIndex(object):
+    def __init__(self, markers, threshold):
+        self.threshold = threshold
+        self.marker_sets = list(set(frozenset(marker.split()) for marker in markers))
+        self.marker_sizes = [len(A) for A in self.marker_sets]
+        self.index = defaultdict(list)
+        for i, A in enumerate(self.marker_sets):
+            for token in A:
+                self.index[token].append(i)
+
+    def matches(self, phrases):
+        phrase_sets = set(frozenset(B) for B in phrases)
+        if self.threshold <= 0:
+            return bool(phrase_sets) and bool(self.marker_sets)
+
+        for B in phrase_sets:
+            candidates = set()
+            for token in B:
+                candidates.update(self.index.get(token, ()))
+            for i in candidates:
+                intersection = len(self.marker_sets[i] & B)
+                union = self.marker_sizes[i] + len(B) - intersection
+                # Same arithmetic as 1 - nltk.metrics.jaccard_distance(A, B)
+                if 1 - (union - intersection) / union >= self.threshold:
+                    return True
+        return False
+
+
+discourse_marker_index = DiscourseMarkerIndex(discourse_markers, global_config.HEDGE_DETECTION_THRESHOLD)
+
+
+def _prepare(text):
     text = text.lower()
 
     if "n't" in text:
@@ -130,31 +261,53 @@ def is_hedged_sentence(text):
     elif "n’t" in text:
         text = text.replace("n’t", " not")
 
-    tokenized = word_tokenize(text)
-    phrases = []
-    status = False
+    return text, word_tokenize(text)
+
+
+# ********* Returns the hedge words of the sentence which have a rule, grouped by the kind of rule ********* #
+def hedge_candidates(tokenized):
+    candidates = {'lexical': [], 'tagged': [], 'parsed': []}
+    for token in set(tokenized):
+        kind = HEDGE_RULES.get(token)
+        if kind is not None:
+            candidates[kind].append(token)
+    return candidates
 
-    # Determine the n-grams of the given sentence
-    for i in range(1, 6):
-        phrases += ngrams(tokenized, i)
 
-    # Determine whether hedge terms are present in the sentence and find out if they are true hedge terms
-    for hedge in hedge_words:
-        if hedge in tokenized and is_true_hedge_term(hedge, text):
-            status = True
-            break
+# ********* Applies the rules which need no CoreNLP annotation ********* #
+def _is_hedged_without_annotation(text, tokenized, candidates):
+    if any(is_true_hedge_term(hedge, text) for hedge in candidates['lexical']):
+        return True
 
-    # Determine whether disocurse markers are present in the n-grams
+    # Determine whether disocurse markers are present in the n-grams of the sentence
     # Use Jaccard distance for measuring similarity
-    if not status:
-        for A in discourse_markers:
-            for B in phrases:
-                distance = 1 - jaccard_distance(set(A.split()), set(list(B)))
-                if distance >= global_config.HEDGE_DETECTION_THRESHOLD:
-                    status = True
-                    break
+    with metrics.timer('discourse_markers'):
+        phrases = []
+        for i in range(1, 6):
+            phrases += ngrams(tokenized, i)
+        return discourse_marker_index.matches(phrases)
+
+
+# The outcome of the rules needing no annotation: `hedged` is True if they decided the sentence is hedged
+CheckedSentence = namedtuple('CheckedSentence', ['text', 'tokenized', 'candidates', 'hedged'])
+
 
-            if status:
-                break
+# ********* Applies the rules which need no CoreNLP annotation to the sentence ********* #
+def check_without_annotation(sentence):
+    text, tokenized = _prepare(sentence)
+    candidates = hedge_candidates(tokenized)
+    return CheckedSentence(text, tokenized, candidates, _is_hedged_without_annotation(text, tokenized, candidates))
 
-    return status
+
+# ********* Determines if a sentence is hedged sentence or not ********* #
+# ********* Returns true if sentence is hedged sentence, otherwise, returns false ********* #
+# ********* Pass `checked` if check_without_annotation(text) already ran, e.g. for annotation_texts() ********* #
+def is_hedged_sentence(text, checked=None):
+    if checked is None:
+        checked = check_without_annotation(text)
+
+    # Request annotations only when the cheaper rules have not decided the sentence
+    if checked.hedged:
+        return True
+    candidates = checked.candidates
+    return any(is_true_hedge_term(hedge, checked.text) for hedge in candidates['tagged'] + candidates['parsed'])